@@ -0,0 +1,586 @@
+"""
+Benchmarks of the image pipeline on synthetic ultrasound frames.
+Run from this directory: python benchmark.py [name ...]
+"""
+import ctypes
+import gc
+import io
+import itertools
+import os
+import sys
+import tempfile
+import tracemalloc
+import weakref
+from threading import Lock
+from time import perf_counter
+from timeit import timeit
+
+import numpy
+import pydicom.config
+from PIL import Image, ImageEnhance, ImageQt
+from PySide6.QtGui import QImage, QPixmap
+from PySide6.QtPrintSupport import QPrinter, QPrintPreviewWidget
+from PySide6.QtCore import QObject
+from PySide6.QtWidgets import QApplication, QListView
+from pydicom import Dataset
+from pydicom.dataset import FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.pixel_data_handlers import numpy_handler, pylibjpeg_handler
+from pydicom.uid import ExplicitVRLittleEndian, JPEGBaseline8Bit, JPEGLSLossless
+
+import report
+import scp
+import tools
+import tune_cache
+from dicomimagelist import ImageListView
+from imagebox import ImageBox
+from imageoptions import ImageOptions
+from imagestore import store
+from optionsform import OptionsForm
+from print_queue import PrintItem
+from pyramid import ImagePyramid, build_levels
+from sonoprint import Sonoprint
+
+# rows, columns of a typical ultrasound frame
+FRAME_SIZE = (600, 800)
+NUMBER = 20
+
+
+def _frame(dtype, high) -> numpy.ndarray:
+    rng = numpy.random.default_rng(0)
+    return rng.integers(0, high, size=FRAME_SIZE, dtype=dtype)
+
+
+def _dataset(bits: int) -> Dataset:
+    """ Windowed MONOCHROME2 ultrasound dataset """
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.Rows, ds.Columns = FRAME_SIZE
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = ds.BitsStored = bits
+    ds.HighBit = bits - 1
+    ds.PixelRepresentation = 0
+    ds.WindowCenter, ds.WindowWidth = (128, 200) if bits == 8 else (2000, 3000)
+    ds.PixelData = _frame(numpy.uint8 if bits == 8 else numpy.uint16,
+                          256 if bits == 8 else 4096).tobytes()
+    return ds
+
+
+def _ms(func, number=NUMBER) -> float:
+    return timeit(func, number=number) / number * 1000
+
+
+def _report(name: str, old: float, new: float):
+    print('{:<32} old {:8.2f} ms   new {:8.2f} ms   x{:.1f}'
+          .format(name, old, new, old / new))
+
+
+def bench_lut():
+    """ numpy.piecewise vs cached Look-Up Table window/level """
+    for name, data, window, level in (('8-bit', _frame(numpy.uint8, 256), 200, 128),
+                                      ('16-bit', _frame(numpy.uint16, 4096), 3000, 2000)):
+        assert numpy.array_equal(tools._get_lut_value(data, window, level),
+                                 tools.apply_window(data, window, level))
+        tools._get_lut.cache_clear()
+        build = _ms(lambda: tools.apply_window(data, window, level), number=1)
+        old = _ms(lambda: tools._get_lut_value(data, window, level))
+        new = _ms(lambda: tools.apply_window(data, window, level))
+        _report('window/level {}'.format(name), old, new)
+        print('{:<32} first call with LUT building {:.2f} ms'.format('', build))
+
+
+def _pil_qimage(ds: Dataset) -> QImage:
+    """ Former get_pixmap_from() path """
+    # every received dataset is decoded once, do not use pydicom cache
+    ds._pixel_id = {}
+    image = tools._get_pil_image(ds)
+    data = image.tobytes("raw", "RGB")
+    return QImage(data, image.size[0], image.size[1], QImage.Format_RGB888)
+
+
+def _check_color():
+    """ JPEG Baseline color comes out RGB, not YCbCr """
+    jpeg = io.BytesIO()
+    Image.new('RGB', (64, 48), (200, 30, 30)).save(jpeg, 'JPEG', quality=95)
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = JPEGBaseline8Bit
+    ds.Rows, ds.Columns = 48, 64
+    ds.SamplesPerPixel = 3
+    ds.PhotometricInterpretation = 'YBR_FULL_422'
+    ds.PlanarConfiguration = 0
+    ds.BitsAllocated = ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.PixelData = encapsulate([jpeg.getvalue()])
+    pixel = tools.get_image_array(ds)[24, 32]
+    assert numpy.abs(pixel.astype(int) - (200, 30, 30)).max() <= 3, 'red came out {}'.format(pixel)
+
+
+def _check_syntaxes():
+    """ SCP does not accept JPEG-LS with pylibjpeg core and no plugin for it """
+    handlers = pydicom.config.pixel_data_handlers
+    pydicom.config.pixel_data_handlers = [numpy_handler, pylibjpeg_handler]
+    if pylibjpeg_handler.HAVE_PYLIBJPEG:
+        import pylibjpeg.utils
+        decoders = pylibjpeg.utils.get_pixel_data_decoders
+        pylibjpeg.utils.get_pixel_data_decoders = dict
+    try:
+        syntaxes = tools.get_decodable_syntaxes(scp.TRANSFER_SYNTAXES)
+    finally:
+        pydicom.config.pixel_data_handlers = handlers
+        if pylibjpeg_handler.HAVE_PYLIBJPEG:
+            pylibjpeg.utils.get_pixel_data_decoders = decoders
+    assert JPEGLSLossless not in syntaxes, 'JPEG-LS accepted without a pylibjpeg plugin'
+    assert ExplicitVRLittleEndian in syntaxes
+
+
+def bench_decode():
+    """ PIL decode + crop vs cropped array view + zero-copy QImage """
+    _check_color()
+    _check_syntaxes()
+    rect = (0, 70, 640, 480)
+    for bits in (8, 16):
+        ds = _dataset(bits)
+        old = _ms(lambda: _pil_qimage(ds).copy(*rect))
+        new = _ms(lambda: tools.array_to_qimage(tools.get_image_array(ds, rect)))
+        _report('decode + crop {}-bit'.format(bits), old, new)
+        tracemalloc.start()
+        image = tools.array_to_qimage(tools.get_image_array(ds, rect))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:<32} peak {:.2f} MB, cropped frame {:.2f} MB'
+              .format('', peak / 2 ** 20, image.sizeInBytes() / 2 ** 20))
+
+
+def _pil_tune(pixmap: QPixmap, brightness, contrast, sharpness) -> QPixmap:
+    """ Former tune_qpixmap() path """
+    tmp_img = ImageQt.fromqpixmap(pixmap)
+    tmp_img = ImageEnhance.Sharpness(tmp_img).enhance(sharpness / 100)
+    tmp_img = ImageEnhance.Brightness(tmp_img).enhance(brightness / 100)
+    tmp_img = ImageEnhance.Contrast(tmp_img).enhance(contrast / 100)
+    return ImageQt.toqpixmap(tmp_img)
+
+
+def _check_tune():
+    """ Fused NumPy kernel within one level of the PIL chain over a grid of slider values """
+    rng = numpy.random.default_rng(0)
+    for shape in ((120, 160), (120, 160, 3)):
+        data = rng.integers(0, 256, size=shape, dtype=numpy.uint8)
+        image = tools.array_to_qimage(data)
+        for values in itertools.product((0, 50, 100, 146, 200, 500),
+                                        (0, 50, 100, 150, 300, 500),
+                                        (-100, 0, 100, 306, 400)):
+            old = Image.fromarray(data)
+            brightness, contrast, sharpness = values
+            for enhance, value in ((ImageEnhance.Sharpness, sharpness),
+                                   (ImageEnhance.Brightness, brightness),
+                                   (ImageEnhance.Contrast, contrast)):
+                old = enhance(old).enhance(value / 100)
+            tuned = tools.tune_qimage(image, *values)
+            # the view lives as long as *tuned*
+            new = tools.qimage_to_array(tuned)
+            difference = numpy.abs(numpy.asarray(old, numpy.int16) - new).max()
+            assert difference <= 1, 'tune{} differs from PIL by {}'.format(values, difference)
+
+
+def bench_tune():
+    """ PIL ImageEnhance chain vs fused NumPy kernel """
+    _check_tune()
+    values = (146, 120, 306)
+    for name, size in (('preview', (300, 400)), ('print', (1100, 1470))):
+        data = _frame(numpy.uint8, 256)
+        data = numpy.asarray(Image.fromarray(data).resize(size[::-1]))
+        pixmap = QPixmap.fromImage(tools.array_to_qimage(data.copy()))
+        image = tools.array_to_qimage(data.copy())
+        old = _ms(lambda: _pil_tune(pixmap, *values))
+        new = _ms(lambda: tools.tune_qimage(image, *values))
+        _report('tune {} {}x{}'.format(name, *size), old, new)
+
+
+class _RelayoutOnResize(ImageListView):
+    """ Former behaviour: full relayout on every resize event """
+
+    def resizeEvent(self, event):
+        QListView.resizeEvent(self, event)
+        self.doItemsLayout()
+
+
+def _resize_fps(view: ImageListView, steps=200) -> float:
+    """ Window edge dragged back and forth, repainted after every step """
+    app = QApplication.instance()
+    view.resize(1200, 800)
+    view.show()
+    app.processEvents()
+    start = perf_counter()
+    for step in range(steps):
+        view.resize(900 + abs(step % 200 - 100) * 8, 800)
+        app.processEvents()
+    return steps / (perf_counter() - start)
+
+
+def bench_resize():
+    """ Relayout on every resize event vs column-count driven relayout """
+    array = _frame(numpy.uint8, 256)[:480, :640].copy()
+    fps = []
+    for view in (_RelayoutOnResize(), ImageListView()):
+        view.image_model.extend([ImageBox(store.add([array]), 'image {}'.format(i))
+                                 for i in range(200)])
+        fps.append(_resize_fps(view))
+        view.close()
+    print('{:<32} old {:8.1f} fps  new {:8.1f} fps  x{:.1f}'
+          .format('resize, 200 images', fps[0], fps[1], fps[1] / fps[0]))
+
+
+class _Study:
+    """ What report.make needs of DicomImageList """
+    clinic = 'Clinic'
+    study_info = 'Patient ID: 1'
+    device_info = 'Device'
+
+    def __init__(self, images: int):
+        image = tools.array_to_qimage(_frame(numpy.uint8, 256)[:480, :640].copy())
+        options = ImageOptions()
+        self.items = [PrintItem(ImagePyramid([image]), 'image {}'.format(i), options)
+                      for i in range(images)]
+
+    def boxes(self):
+        return iter(self.items)
+
+
+def bench_report():
+    """ Print preview repaint: every image scaled and tuned vs the print cache """
+    study = _Study(12)
+    preview = QPrintPreviewWidget()
+    cached = [False]
+
+    def paint(printer: QPrinter):
+        if not cached[0]:
+            report.cache.clear()
+        report.make(printer, study)
+
+    preview.paintRequested.connect(paint)
+    old = _ms(preview.updatePreview, number=3)
+    cached[0] = True
+    new = _ms(preview.updatePreview, number=3)
+    _report('preview repaint, 12 images', old, new)
+
+
+def bench_print():
+    """ 24 images scaled and tuned on one thread vs PRINT_WORKERS threads """
+    study = _Study(24)
+    preview = QPrintPreviewWidget()
+
+    def paint(printer: QPrinter):
+        report.cache.clear()
+        report.make(printer, study)
+
+    preview.paintRequested.connect(paint)
+    workers = report.PRINT_WORKERS
+    report.PRINT_WORKERS = 1
+    old = _ms(preview.updatePreview, number=3)
+    report.PRINT_WORKERS = workers
+    new = _ms(preview.updatePreview, number=3)
+    _report('print, 24 images, {} threads'.format(workers), old, new)
+    print('{:<32} {} CPUs'.format('', os.cpu_count()))
+
+
+def _peak_print_images(func) -> float:
+    """ Peak size of the print images alive at once during *func*, MB """
+    lock = Lock()
+    alive = peak = 0
+    tune_qimage = tune_cache.tune_qimage
+
+    def freed(size: int):
+        nonlocal alive
+        with lock:
+            alive -= size
+
+    def counted(*args) -> QImage:
+        nonlocal alive, peak
+        image = tune_qimage(*args)
+        with lock:
+            alive += image.sizeInBytes()
+            peak = max(peak, alive)
+        weakref.finalize(image, freed, image.sizeInBytes())
+        return image
+
+    tune_cache.tune_qimage = counted
+    try:
+        func()
+    finally:
+        tune_cache.tune_qimage = tune_qimage
+    return peak / 2 ** 20
+
+
+def bench_report_memory():
+    """
+    Report to PDF: every print image kept as then vs the print cache at
+    PRINT_CACHE_MB and the rest streamed page by page
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'report.pdf')
+    budget = report.cache.budget
+
+    def make(study: _Study, cache_budget: int) -> float:
+        printer = QPrinter()
+        printer.setOutputFormat(QPrinter.PdfFormat)
+        printer.setOutputFileName(path)
+        report.cache.budget = cache_budget
+        peak = _peak_print_images(lambda: report.make(printer, study))
+        report.cache.clear()
+        return peak
+
+    # nothing cached: the pages on the way
+    streamed = make(_Study(96), 0)
+    for images in (12, 48, 96):
+        study = _Study(images)
+        old, new = make(study, 2 ** 40), make(study, budget)
+        print('{:<32} old {:8.1f} MB   new {:8.1f} MB'
+              .format('print images, {} images'.format(images), old, new))
+        assert new <= budget / 2 ** 20 + streamed, \
+            '{} images: {:.1f} MB of print images'.format(images, new)
+    report.cache.budget = budget
+    os.remove(path)
+
+
+def bench_raster():
+    """
+    Printer spool of 24 images: pages painted as is vs one raster image
+    per page. Printers get PDF from Qt, so the spool is written to a file.
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'spool.pdf')
+    study = _Study(24)
+
+    def spool(raster: int) -> tuple:
+        printer = QPrinter()
+        printer.setOutputFormat(QPrinter.PdfFormat)
+        printer.setOutputFileName(path)
+        first_page = []
+        new_page = printer.newPage
+
+        def timed_new_page() -> bool:
+            first_page.append(perf_counter())
+            return new_page()
+
+        printer.newPage = timed_new_page
+        report.cache.clear()
+        start = perf_counter()
+        report.make(printer, study, raster)
+        first_page.append(perf_counter())
+        return os.path.getsize(path) / 2 ** 20, (first_page[0] - start) * 1000
+
+    old_size, old_time = spool(0)
+    for raster, name in ((8, 'grayscale'), (1, 'dithered')):
+        size, time = spool(raster)
+        print('{:<32} old {:8.2f} MB   new {:8.2f} MB   x{:.1f}'
+              .format('spool, {}'.format(name), old_size, size, old_size / size))
+        _report('first page, {}'.format(name), old_time, time)
+    os.remove(path)
+
+
+def _check_discard():
+    """ Tuned images of a box go with its options and with its pixels """
+    box = ImageBox(store.add(build_levels(_frame(numpy.uint8, 256))), 'image')
+    box.options.set(146, 120, 306)
+    box.draw()
+    count = len(tune_cache.cache.images)
+    box.options_changed()
+    assert len(tune_cache.cache.images) == count - 1, 'options_changed kept the former tune'
+    store.release(box.image_id)
+    assert len(tune_cache.cache.images) == count - 2, 'release kept the tuned images'
+
+
+def bench_tune_cache():
+    """
+    200 list images drawn with the saved and the default options by turns,
+    as OptionsForm Load/Reset and settings_changed do: tuned every time
+    vs TUNE_CACHE_MB cache
+    """
+    _check_discard()
+    image = tools.array_to_qimage(_frame(numpy.uint8, 256)[:360, :480].copy())
+    images = [(tune_cache.new_image_id(), image.copy()) for _ in range(200)]
+    values = ((146, 120, 306), (100, 100, 100))
+    test_cache = tune_cache.TuneCache(tune_cache.TUNE_CACHE_MB * 2 ** 20)
+
+    def draw(cache: tune_cache.TuneCache):
+        for options in values * 3:
+            for image_id, view_image in images:
+                cache.tune(image_id, view_image, *options)
+
+    old = _ms(lambda: draw(tune_cache.TuneCache(0)), number=1)
+    new = _ms(lambda: draw(test_cache), number=1)
+    _report('200 images, 6 redraws', old, new)
+    print('{:<32} {}'.format('', test_cache.status()))
+
+
+def bench_pyramid():
+    """
+    ImageBox of a received 800x600 image on the GUI thread: scaled from
+    full resolution vs the preview level of the pyramid from the decode worker
+    """
+    array = _frame(numpy.uint8, 256)
+    levels = build_levels(array)
+    old = _ms(lambda: ImageBox(store.add([array]), 'image'))
+    new = _ms(lambda: ImageBox(store.add(levels), 'image'))
+    _report('image box, GUI thread', old, new)
+    print('{:<32} {:8.2f} ms in the decode worker'
+          .format('pyramid levels', _ms(lambda: build_levels(array))))
+
+
+class _EagerOptionsBox(ImageBox):
+    """ Former ImageBox: OptionsForm made with the box """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.form = OptionsForm(self.scaled_image, (self.image_id, 0), self.options)
+
+
+def _rss() -> int:
+    """
+    Resident set size of the process, bytes, 0 where /proc is missing.
+    Freed heap is given back first, so growth is not hidden by its reuse.
+    """
+    if not os.path.exists('/proc/self/statm'):
+        return 0
+    gc.collect()
+    ctypes.CDLL(None).malloc_trim(0)
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class _PixmapBox(_EagerOptionsBox):
+    """ ImageBox before imagestore: 32 bit QPixmaps of the tuned image in the box and form label """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.pixmap = QPixmap.fromImage(self.tuned_image)
+        self.form.img.setPixmap(QPixmap.fromImage(self.tuned_image))
+
+
+def bench_image_store():
+    """
+    Memory held per received 800x600 image, 100 images with their own
+    levels and tuned images, OptionsForm made with every box as then:
+    QPixmaps of the tuned image in ImageBox and in the OptionsForm label
+    vs imagestore levels and the tuned image shared with tune_cache only
+    """
+    array = _frame(numpy.uint8, 256)
+    results = {}
+    boxes = []
+    # both kept till the end, so the second does not reuse memory freed by the first
+    for name, box_class in (('new', _EagerOptionsBox), ('old', _PixmapBox)):
+        rss = _rss()
+        boxes.extend(box_class(store.add(build_levels(array.copy())), 'image {}'.format(i))
+                     for i in range(100))
+        results[name] = (_rss() - rss) / 100 / 2 ** 10
+    levels, tuned = store.held(boxes[0].image_id)
+    for box in boxes:
+        store.release(box.image_id)
+    if results['old']:
+        print('{:<32} old {:8.1f} KB   new {:8.1f} KB   x{:.1f}'
+              .format('RSS per image', results['old'], results['new'],
+                      results['old'] / results['new']))
+    # pixels only: levels, tuned image and the two 32 bit copies of it
+    pixmap = QPixmap.fromImage(tools.array_to_qimage(build_levels(array)[1]))
+    pixmap_bytes = pixmap.width() * pixmap.height() * pixmap.depth() // 8
+    old = (levels + tuned + pixmap_bytes * 2) / 2 ** 10
+    new = (levels + tuned) / 2 ** 10
+    print('{:<32} old {:8.1f} KB   new {:8.1f} KB   x{:.1f}'
+          .format('pixels per image, estimate', old, new, old / new))
+    tune_cache.cache.clear()
+
+
+def bench_lazy_options():
+    """
+    Ingest of 200 received 800x600 images: OptionsForm made with every
+    ImageBox vs ImageOptions only, the dialog made when '...' is clicked
+    """
+    levels = build_levels(_frame(numpy.uint8, 256))
+    image_id = store.add(levels)
+    results = {}
+    # the lighter one first, RSS does not shrink after the other
+    for name, box_class in (('new', ImageBox), ('old', _EagerOptionsBox)):
+        rss = _rss()
+        start = perf_counter()
+        boxes = [box_class(image_id, 'image {}'.format(i)) for i in range(200)]
+        time = (perf_counter() - start) / len(boxes) * 1000
+        objects = len(boxes[0].findChildren(QObject)) + 1
+        if isinstance(boxes[0], _EagerOptionsBox):
+            objects += len(boxes[0].form.findChildren(QObject)) + 1
+        results[name] = time, objects, (_rss() - rss) / len(boxes) / 2 ** 10
+    (old_time, old_objects, old_rss), (new_time, new_objects, new_rss) = \
+        results['old'], results['new']
+    _report('image box ingest', old_time, new_time)
+    print('{:<32} old {:8d}      new {:8d}      x{:.1f}'
+          .format('QObjects per image', old_objects, new_objects, old_objects / new_objects))
+    if old_rss:
+        print('{:<32} old {:8.1f} KB   new {:8.1f} KB'
+              .format('RSS per image', old_rss, new_rss))
+    store.release(image_id)
+
+
+def bench_options_preview():
+    """
+    OptionsForm slider dragged over 60 values, 10 ms apart with a 50 ms
+    stop every 10: every value rendered in full on the GUI thread vs
+    debounced quarter resolution drafts off it and one full render on release
+    """
+    app = QApplication.instance()
+    image_id = store.add(build_levels(_frame(numpy.uint8, 256)))
+    box = ImageBox(image_id, 'image')
+    form = OptionsForm(box.scaled_image, (image_id, 0), box.options)
+    values = (form.brightness(), form.contrast(), form.sharpness())
+    full = _ms(lambda: QPixmap.fromImage(tools.tune_qimage(form.image, *values)))
+    draft = _ms(lambda: QPixmap.fromImage(tools.tune_qimage(form.thumbnail, *values))
+                .scaled(form.image.size()))
+    _report('render while dragging', full, draft)
+
+    renders = []
+    render_image = form.render_image
+
+    def counted(number: int, *args):
+        renders.append(number)
+        render_image(number, *args)
+
+    def wait(ms: float):
+        end = perf_counter() + ms / 1000
+        while perf_counter() < end:
+            app.processEvents()
+
+    form.render_image = counted
+    form.show()
+    wait(100)
+    renders.clear()
+    form.sldBrightness.setSliderDown(True)
+    for value in range(100, 160):
+        form.sldBrightness.setValue(value)
+        wait(50 if value % 10 == 9 else 10)
+    form.sldBrightness.setSliderDown(False)
+    wait(100)
+    form.hide()
+    print('{:<32} old {:8d}      new {:8d}      x{:.1f}'
+          .format('renders, 60 slider values', 60, len(renders), 60 / len(renders)))
+    store.release(image_id)
+
+
+BENCHMARKS = {'lut': bench_lut,
+              'decode': bench_decode,
+              'tune': bench_tune,
+              'resize': bench_resize,
+              'report': bench_report,
+              'print': bench_print,
+              'report_memory': bench_report_memory,
+              'raster': bench_raster,
+              'tune_cache': bench_tune_cache,
+              'pyramid': bench_pyramid,
+              'image_store': bench_image_store,
+              'lazy_options': bench_lazy_options,
+              'options_preview': bench_options_preview}
+
+if __name__ == '__main__':
+    # widgets of the image list need the application of sonoprint
+    app = Sonoprint(sys.argv[:1])
+    for bench in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[bench]()
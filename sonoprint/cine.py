@@ -0,0 +1,133 @@
+import struct
+from bisect import bisect_right
+from collections import OrderedDict
+from threading import Lock
+
+import numpy
+from pydicom import Dataset
+from pydicom.encaps import encapsulate, generate_pixel_data_frame
+from pydicom.tag import Tag
+
+import spool
+from pyramid import ImagePyramid
+from settings import settings
+from tools import array_to_qimage, get_image_array, get_fragments
+
+# loading settings:
+# Decoded frames kept in memory per cine clip
+CINE_CACHE_FRAMES = int(settings.CINE_CACHE_FRAMES)
+
+# elements that single frame datasets do not share with the clip
+OWN_TAGS = (Tag('NumberOfFrames'), Tag('PixelData'), Tag('PhotometricInterpretation'))
+
+
+def _get_frame_index(pixel_data: bytes, frames: int):
+    """
+    Fragments (start, stop) of every frame of encapsulated PixelData
+    or None if frame boundaries are unknown without parsing the codestream
+    """
+    items = get_fragments(pixel_data)
+    if not items:
+        return None
+    (bot_start, bot_stop), fragments = items[0], items[1:]
+    if bot_stop > bot_start:
+        # Basic Offset Table, offsets from the first fragment item tag
+        offsets = struct.unpack_from('<{}I'.format((bot_stop - bot_start) // 4),
+                                     pixel_data, bot_start)
+        first = fragments[0][0] - 8
+        index = [[] for _ in offsets]
+        for fragment in fragments:
+            index[bisect_right(offsets, fragment[0] - 8 - first) - 1].append(fragment)
+        return index
+    if len(fragments) == frames:
+        return [[fragment] for fragment in fragments]
+    if frames == 1:
+        return [fragments]
+    return None
+
+
+class FrameSource:
+    """
+    Frames of a multi-frame (cine) DICOM file, decoded on demand and kept
+    in a small LRU, so memory does not grow with the clip length.
+    PixelData stays in the memory-mapped file. Frames may be decoded on
+    the decode pool threads and the GUI thread at once.
+    """
+
+    def __init__(self, path: str, rect=None):
+        self.path = path
+        self._dataset = None
+        self.rect = rect
+        dataset = self.dataset
+        self.count = int(dataset.get('NumberOfFrames', 1))
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        self.index = None
+        self.encoded = None
+        if dataset.file_meta.TransferSyntaxUID.is_encapsulated:
+            self.index = _get_frame_index(dataset.PixelData, self.count)
+            if self.index is None:
+                self.encoded = list(generate_pixel_data_frame(dataset.PixelData,
+                                                              self.count))
+
+    def __getstate__(self) -> dict:
+        # the file is mapped again after pickling to other process
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        state['cache'] = OrderedDict()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    @property
+    def dataset(self) -> Dataset:
+        if self._dataset is None:
+            self._dataset = spool.read(self.path)
+        return self._dataset
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, frame: int) -> numpy.ndarray:
+        with self.lock:
+            if frame in self.cache:
+                self.cache.move_to_end(frame)
+                return self.cache[frame]
+        array = self._decode(frame)
+        self.keep(frame, array)
+        return array
+
+    def keep(self, frame: int, array: numpy.ndarray):
+        """ Cache *frame*, also one decoded by a process pool worker """
+        with self.lock:
+            self.cache[frame] = array
+            self.cache.move_to_end(frame)
+            if len(self.cache) > CINE_CACHE_FRAMES:
+                self.cache.popitem(last=False)
+
+    def print_images(self, frames, image_info: str):
+        """ (ImagePyramid, image_info) of *frames*, each decoded when asked for """
+        for frame in frames:
+            yield (ImagePyramid([array_to_qimage(self[frame])]),
+                   '{}, frame {}'.format(image_info, frame + 1))
+
+    def _decode(self, frame: int) -> numpy.ndarray:
+        if self.index is None and self.encoded is None:
+            return get_image_array(self.dataset, self.rect, frame)
+        if self.encoded is not None:
+            data = self.encoded[frame]
+        else:
+            pixel_data = memoryview(self.dataset.PixelData)
+            data = b''.join(pixel_data[start:stop] for start, stop in self.index[frame])
+        # single frame dataset sharing all other elements
+        single = Dataset({tag: element for tag, element in self.dataset.items()
+                          if tag not in OWN_TAGS})
+        single.file_meta = self.dataset.file_meta
+        # codecs may change it to 'RGB' after color conversion
+        single.PhotometricInterpretation = self.dataset.PhotometricInterpretation
+        single.NumberOfFrames = 1
+        single.PixelData = encapsulate([data])
+        return get_image_array(single, self.rect)
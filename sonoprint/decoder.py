@@ -0,0 +1,170 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, BrokenExecutor
+from datetime import datetime
+from functools import partial
+from multiprocessing import get_context
+from threading import RLock
+
+import numpy
+from PySide6.QtCore import QObject, Signal
+from pydicom import Dataset
+
+import spool
+from cine import FrameSource
+from pyramid import build_levels
+from settings import settings, unpack_int
+from tools import get_image_array, decode_rus, log_to_file
+
+# loading settings:
+# 'thread' or 'process'
+DECODE_POOL = settings.DECODE_POOL
+DECODE_WORKERS = int(settings.DECODE_WORKERS)
+# Not more than this number of datasets are decoded at once
+DECODE_MAX_IN_FLIGHT = int(settings.DECODE_MAX_IN_FLIGHT)
+# Not more than this number of images are received, but not shown yet
+INGEST_QUEUE_SIZE = int(settings.INGEST_QUEUE_SIZE)
+
+IMAGE_CROPPING_RECT = unpack_int(settings.IMAGE_CROPPING_RECT)
+
+
+class DecodedImage:
+    """ Ready-to-show image with its description """
+
+    def __init__(self, path: str, array: numpy.ndarray, image_info: str,
+                 header: Dataset, frames: FrameSource = None):
+        self.path = path
+        self.array = array
+        # full, preview and thumbnail, see pyramid.ImagePyramid
+        self.levels = build_levels(array)
+        self.image_info = image_info
+        # dataset without PixelData
+        self.header = header
+        # first frame is *array*
+        self.frames = frames
+
+
+def decode(path: str) -> DecodedImage:
+    """
+    Turn DICOM file into cropped image, the first frame for cine clips.
+    Runs in the worker pool, so must stay picklable and GUI-free.
+    """
+    ds = spool.read(path)
+    frames = None
+    if int(ds.get('NumberOfFrames', 1)) > 1:
+        frames = FrameSource(path, IMAGE_CROPPING_RECT)
+        array = frames[0]
+    else:
+        array = get_image_array(ds, IMAGE_CROPPING_RECT)
+
+    ict = datetime.strptime(ds.InstanceCreationTime, '%H%M%S').time()
+    image_info = '№{} at {}, sensor: {}, {}'.format(ds.InstanceNumber,
+                                                    ict,
+                                                    ds.TransducerData[0],
+                                                    decode_rus(ds.ProcessingFunction, ds))
+    del ds.PixelData
+    if frames is not None:
+        image_info = '{}, {} frames'.format(image_info, len(frames))
+    return DecodedImage(path, array, image_info, ds, frames)
+
+
+def decode_frame(frames: FrameSource, frame: int) -> numpy.ndarray:
+    """ Cine clip frame, runs in the worker pool as decode """
+    return frames[frame]
+
+
+class DecodePipeline(QObject):
+    """
+    Decodes DICOM files on a thread or process pool and emits *decoded*
+    in arrival order. *submit* may be called from any thread.
+    Like queue.Queue, receiver of *decoded* calls *task_done* when the
+    image is shown, *depth* counts images submitted but not shown yet.
+    """
+    decoded = Signal(DecodedImage)
+
+    def __init__(self):
+        super().__init__()
+        self.pool = self._new_pool()
+        self.lock = RLock()
+        self.waiting = deque()
+        self.in_flight = 0
+        # finished, but not emitted yet (waiting for earlier ones)
+        self.finished = {}
+        self.next_in = 0
+        self.next_out = 0
+        self.depth = 0
+
+    @staticmethod
+    def _new_pool():
+        if DECODE_POOL == 'process':
+            # forking a process with Qt and SCP threads running may deadlock
+            return ProcessPoolExecutor(max_workers=DECODE_WORKERS,
+                                       mp_context=get_context('spawn'))
+        return ThreadPoolExecutor(max_workers=DECODE_WORKERS,
+                                  thread_name_prefix='decode')
+
+    def full(self) -> bool:
+        return self.depth >= INGEST_QUEUE_SIZE
+
+    def task_done(self):
+        with self.lock:
+            self.depth -= 1
+
+    def submit(self, path: str):
+        with self.lock:
+            self.depth += 1
+            self.waiting.append((self.next_in, path))
+            self.next_in += 1
+            self._start_waiting()
+
+    def submit_frame(self, frames: FrameSource, frame: int) -> Future:
+        """ Decode a frame of a shown clip, out of the ingest order and depth """
+        return self._submit(decode_frame, frames, frame)
+
+    def _submit(self, fn, *args) -> Future:
+        """ Process pool broken by a crashed worker takes no work, it is made again """
+        with self.lock:
+            try:
+                return self.pool.submit(fn, *args)
+            except BrokenExecutor as e:
+                log_to_file('DECODE ERROR: {}, new pool is started'.format(e))
+                self.pool.shutdown(wait=False)
+                self.pool = self._new_pool()
+                return self.pool.submit(fn, *args)
+
+    def _start_waiting(self):
+        while self.waiting and self.in_flight < DECODE_MAX_IN_FLIGHT:
+            number, path = self.waiting.popleft()
+            try:
+                future = self._submit(decode, path)
+            except Exception as e:
+                # dropped as a file failed to decode, so depth does not stay up
+                log_to_file('DECODE ERROR: {}: {}'.format(path, e))
+                self.depth -= 1
+                self.finished[number] = None
+                self._emit_finished()
+                continue
+            self.in_flight += 1
+            future.add_done_callback(partial(self._done, number))
+
+    def _emit_finished(self):
+        # emit under the lock, otherwise two workers may swap the order
+        while self.next_out in self.finished:
+            image = self.finished.pop(self.next_out)
+            self.next_out += 1
+            if image is not None:
+                # noinspection PyUnresolvedReferences
+                self.decoded.emit(image)
+
+    def _done(self, number: int, future: Future):
+        try:
+            image = future.result()
+        except Exception as e:
+            log_to_file('DECODE ERROR: {}'.format(e))
+            image = None
+        with self.lock:
+            self.in_flight -= 1
+            if image is None:
+                self.depth -= 1
+            self.finished[number] = image
+            self._emit_finished()
+            self._start_waiting()
@@ -1,141 +1,233 @@
-import sys
-from codecs import decode
 from datetime import datetime
 
-from PySide6.QtCore import Signal, Qt, Slot, QRect
-from PySide6.QtGui import QMouseEvent
-from PySide6.QtWidgets import (QListWidget, QListWidgetItem)
+from PySide6.QtCore import Qt, Slot, QAbstractListModel, QModelIndex, QTimer
+from PySide6.QtGui import QMouseEvent, QResizeEvent
+from PySide6.QtWidgets import QListView, QStyle, QApplication
 from pydicom import Dataset
-from pydicom.uid import ImplicitVRLittleEndian
-from pynetdicom import AE, evt
-from pynetdicom.events import Event
 
+import spool
+from decoder import DecodePipeline, DecodedImage, INGEST_QUEUE_SIZE
 from imagebox import ImageBox
-from tools import get_pixmap_from, try_port, decode_rus, log_to_file
-from settings import settings, unpack_int
+from imagedelegate import ImageBoxDelegate, BOX_ROLE
+from imagestore import store
+from print_scp import PrintSCP, DICOM_PRINT_SCP
+from scp import StoreSCP
+from tools import get_study_info
+from settings import settings
 
 # loading settings:
 # Spacing between ImageBoxes in ImageList
 IMAGE_LIST_SPACING = int(settings.IMAGE_LIST_SPACING)
-# port for listening
-DICOM_SCP_PORT = int(settings.DICOM_SCP_PORT)
-# 400px - target width of image for ImageBox
-
-IMAGE_CROPPING_RECT = QRect(*unpack_int(settings.IMAGE_CROPPING_RECT))
-
-
-class DicomImageList(QListWidget):
-    store_signal = Signal(Dataset)
+# Images received within this interval (ms) are added to the list at once
+IMAGE_LIST_BATCH_INTERVAL = int(settings.IMAGE_LIST_BATCH_INTERVAL)
+# Columns are recounted not more often than this interval (ms) on resizing
+IMAGE_LIST_RESIZE_INTERVAL = int(settings.IMAGE_LIST_RESIZE_INTERVAL)
+
+
+class ImageListModel(QAbstractListModel):
+    """ ImageBoxes of the study """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.boxes = []
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.boxes)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        box = self.boxes[index.row()]
+        if role == BOX_ROLE:
+            return box
+        if role == Qt.DisplayRole:
+            return box.image_info
+        if role == Qt.DecorationRole:
+            return box.tuned_image
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if box.isChecked() else Qt.Unchecked
+        if role == Qt.EditRole:
+            return box.comment_text()
+        return None
+
+    def setData(self, index: QModelIndex, value, role: int = Qt.EditRole) -> bool:
+        if not index.isValid():
+            return False
+        box = self.boxes[index.row()]
+        if role == Qt.CheckStateRole:
+            box.setChecked(Qt.CheckState(value) == Qt.Checked)
+        elif role == Qt.EditRole:
+            box.set_comment(value)
+        else:
+            return False
+        return True
+
+    def flags(self, index: QModelIndex) -> Qt.ItemFlags:
+        return (Qt.ItemIsEnabled | Qt.ItemIsSelectable |
+                Qt.ItemIsEditable | Qt.ItemIsUserCheckable)
+
+    def extend(self, boxes: list):
+        """ One model update for all the *boxes* """
+        row = len(self.boxes)
+        self.beginInsertRows(QModelIndex(), row, row + len(boxes) - 1)
+        self.boxes.extend(boxes)
+        for box in boxes:
+            box.changed.connect(self.box_changed)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.boxes = []
+        self.endResetModel()
+
+    @Slot()
+    def box_changed(self):
+        box = self.sender()
+        if box in self.boxes:
+            index = self.index(self.boxes.index(box))
+            self.dataChanged.emit(index, index)
+
+
+class ImageListView(QListView):
+    """
+    Grid of ImageBoxes. All the boxes are equally wide, so items move
+    only when the number of columns fitting the viewport changes; it is
+    checked not more often than every IMAGE_LIST_RESIZE_INTERVAL ms.
+    """
 
     def __init__(self):
         super().__init__()
-        self.setViewMode(QListWidget.IconMode)
+        self.setViewMode(QListView.IconMode)
+        self.setMovement(QListView.Static)
+        # relayout is done by resizeEvent
+        self.setResizeMode(QListView.Fixed)
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
         self.setSpacing(IMAGE_LIST_SPACING)
-        self.setDragDropMode(QListWidget.DragDropMode.NoDragDrop)
+        self.setDragDropMode(QListView.DragDropMode.NoDragDrop)
+        # the editor of the clicked ImageBox only
+        self.setEditTriggers(QListView.CurrentChanged | QListView.SelectedClicked)
+
+        self.image_model = ImageListModel(self)
+        self.setModel(self.image_model)
+        self.setItemDelegate(ImageBoxDelegate(self))
+
+        self.columns = 0
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(IMAGE_LIST_RESIZE_INTERVAL)
+        # noinspection PyUnresolvedReferences
+        self.resize_timer.timeout.connect(self.relayout)
+
+    def column_count(self) -> int:
+        """ Columns QListView static layout makes in the current viewport """
+        if not self.image_model.rowCount():
+            return 0
+        item_width = self.sizeHintForIndex(self.image_model.index(0)).width()
+        # the layout always leaves room for the vertical scroll bar
+        width = (self.maximumViewportSize().width() -
+                 self.style().pixelMetric(QStyle.PM_ScrollBarExtent, None,
+                                          self.verticalScrollBar()))
+        return max(1, (width - self.spacing()) // (item_width + self.spacing()))
+
+    def doItemsLayout(self):
+        self.columns = self.column_count()
+        super().doItemsLayout()
+
+    def resizeEvent(self, event: QResizeEvent):
+        super().resizeEvent(event)
+        if not self.resize_timer.isActive():
+            self.resize_timer.start()
+
+    @Slot()
+    def relayout(self):
+        if self.column_count() != self.columns:
+            self.scheduleDelayedItemsLayout()
 
-        self.clinic = self.study_info = self.device_info = self.patient_id = ''
+    def boxes(self):
+        return iter(self.image_model.boxes)
 
-        # --------------------------
-        # Init and Start SCP server
-        # UltrasoundImageStorage - 1.2.840.10008.5.1.4.1.1.6.1
-        # --------------------------
-        # noinspection PyUnresolvedReferences
-        self.store_signal.connect(self.store_signal_handler)
-        self.__handlers = [(evt.EVT_C_STORE, self.handle_c_store),
-                           (evt.EVT_C_ECHO, self.handle_c_echo)]
-        self.ae = AE()
-        self.ae.add_supported_context('1.2.840.10008.5.1.4.1.1.6.1',
-                                      ImplicitVRLittleEndian)
-        self.ae.add_supported_context('1.2.840.10008.1.1',
-                                      ImplicitVRLittleEndian)
-        if try_port(DICOM_SCP_PORT):
-            self.ae.start_server(('', DICOM_SCP_PORT), block=False, ae_title=b'SONOPRINT',
-                                 evt_handlers=self.__handlers)
-        else:
-            sys.exit(-1)
-        # --------------------------
-
-    def handle_c_store(self, event: Event) -> int:
-        """
-        Handle EVT_C_STORE events.
-        https://ru.wikipedia.org/wiki/DICOM
-        """
-        print('{}: {} from {} on {} (port {})'.
-              format(event.timestamp,
-                     event.event.description,
-                     decode(event.assoc.requestor.ae_title, 'UTF-8').strip(),
-                     event.assoc.requestor.address,
-                     event.assoc.requestor.port))
-        try:
-            ds = event.dataset
-            ds.file_meta = event.file_meta
-            # noinspection PyUnresolvedReferences
-            self.store_signal.emit(ds)
-        except Exception as e:
-            log_to_file('\n HANDLE_C_STORE ERROR: {}'.format(e))
-            return 0xC001
-        return 0x0000
-
-    def handle_c_echo(self, event: Event) -> int:
-        print('{}: {} from {} on {} (port {})'.
-              format(event.timestamp,
-                     event.event.description,
-                     decode(event.assoc.requestor.ae_title, 'UTF-8').strip(),
-                     event.assoc.requestor.address,
-                     event.assoc.requestor.port))
-        return 0x0000
+    def mouseDoubleClickEvent(self, event: QMouseEvent):
+        index = self.indexAt(event.pos())
+        if index.isValid():
+            index.data(BOX_ROLE).change()
 
-    def get_dicom_info(self, ds: Dataset):
 
-        self.clinic = '{}  '. \
-            format(decode_rus(ds.InstitutionName, ds))
+class DicomImageList(ImageListView):
 
-        self.patient_id = ds.PatientID
-        sd = ds.StudyDate
-        st = ds.StudyTime
-        dd = datetime.strptime('{} {}'.format(sd, st), '%Y%m%d %H%M%S')
-        self.study_info = 'Patient ID: {}, Study time: {}'. \
-            format(self.patient_id,
-                   dd.strftime('%d.%m.%Y %H:%M'))
+    def __init__(self):
+        super().__init__()
 
-        self.device_info = 'Device: {} {} SN:{} firmware version: {}'. \
-            format(ds.Manufacturer,
-                   ds.ManufacturerModelName,
-                   ds.DeviceSerialNumber,
-                   ds.SoftwareVersions)
+        self.clinic = self.study_info = self.device_info = self.patient_id = ''
+        # spooled files of the shown images
+        self.spooled = []
+        spool.purge()
+
+        # boxes waiting for insertion and size of the last inserted batch
+        self.batch = []
+        self.batch_size = 0
+        self.batch_timer = QTimer(self)
+        self.batch_timer.setSingleShot(True)
+        self.batch_timer.setInterval(IMAGE_LIST_BATCH_INTERVAL)
+        # noinspection PyUnresolvedReferences
+        self.batch_timer.timeout.connect(self.insert_batch)
+
+        self.pipeline = DecodePipeline()
+        # noinspection PyUnresolvedReferences
+        self.pipeline.decoded.connect(self.decoded_handler)
+        self.print_scp = PrintSCP()
+        self.scp = StoreSCP(self.pipeline, self.print_scp if DICOM_PRINT_SCP else None)
+
+        # one connection for all the boxes, they have no OptionsForm of their own
+        QApplication.instance().settings_changed.connect(self.settings_changed_handler)
 
-    @Slot(Dataset)
-    def store_signal_handler(self, ds: Dataset):
+    def get_dicom_info(self, ds: Dataset):
+        self.clinic, self.patient_id, self.study_info, self.device_info = \
+            get_study_info(ds)
 
+    @Slot(DecodedImage)
+    def decoded_handler(self, image: DecodedImage):
+        ds = image.header
         if self.patient_id != ds.PatientID:
             # new study starting
             self.clear()
             self.get_dicom_info(ds)
 
-        ict = datetime.strptime(ds.InstanceCreationTime, '%H%M%S').time()
-        box = ImageBox(get_pixmap_from(ds).copy(IMAGE_CROPPING_RECT),
-                       '№{} at {}, sensor: {}, {}'
-                       .format(ds.InstanceNumber,
-                               ict,
-                               ds.TransducerData[0],
-                               decode_rus(ds.ProcessingFunction, ds)))
-
-        view_item = QListWidgetItem(self)
-        view_item.setSizeHint(box.size())
-        self.addItem(view_item)
-        self.setItemWidget(view_item, box)
-
-    def resizeEvent(self, event):
-        # TODO: Awful decision. Refresh if window resized
-        self.takeItem(self.row(QListWidgetItem(self)))
-
-    def boxes(self):
-        for i in range(self.count()):
-            yield self.itemWidget(self.item(i))
-
-    def mouseDoubleClickEvent(self, event: QMouseEvent):
-        item = self.itemAt(event.pos())
-        if item:
-            self.itemWidget(item).change()
+        if spool.is_spooled(image.path):
+            self.spooled.append(image.path)
+        self.batch.append(ImageBox(store.add(image.levels), image.image_info, image.frames,
+                                   self.pipeline))
+        if not self.batch_timer.isActive():
+            self.batch_timer.start()
+
+    @Slot()
+    def insert_batch(self):
+        if not self.batch:
+            return
+        self.image_model.extend(self.batch)
+        for _ in self.batch:
+            self.pipeline.task_done()
+        self.batch_size = len(self.batch)
+        self.batch = []
+
+    @Slot()
+    def settings_changed_handler(self):
+        for box in self.image_model.boxes + self.batch:
+            box.load_options()
+
+    def ingest_status(self) -> str:
+        return 'Ingest queue: {}/{}, refused: {}, last batch: {}'.format(
+            self.pipeline.depth, INGEST_QUEUE_SIZE, self.scp.rejected, self.batch_size)
+
+    def clear(self):
+        if self.image_model.boxes or self.batch:
+            print('{}: {} of {}'.format(datetime.now(), store.report(), self.study_info))
+        for box in self.image_model.boxes + self.batch:
+            store.release(box.image_id)
+        # images of the previous study waiting for insertion
+        for _ in self.batch:
+            self.pipeline.task_done()
+        self.batch = []
+        self.image_model.clear()
+        spool.remove(self.spooled)
+        self.spooled = []
@@ -0,0 +1,107 @@
+"""
+Batch export of DICOM files to report PDFs, one per study, with the
+layout of report.make. Studies are exported in parallel processes on
+the offscreen Qt platform, e.g. to re-issue reports after a printer outage.
+Run from this directory: python export.py SOURCE OUTPUT [--images png|jpg]
+"""
+import argparse
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import freeze_support
+
+from PySide6.QtGui import QGuiApplication
+from pydicom import dcmread
+
+import report
+from decoder import decode
+from imageoptions import ImageOptions
+from print_queue import PrintItem
+from print_server import PrintStudy, pdf_printer
+from pyramid import ImagePyramid
+from tools import tune_qimage, log_to_file
+
+# QGuiApplication of the worker process
+_app = None
+
+
+def find_studies(source: str) -> list:
+    """ Paths of .dcm files under *source* grouped by study, in instance order """
+    studies = defaultdict(list)
+    for root, _, names in os.walk(source):
+        for name in names:
+            if not name.lower().endswith('.dcm'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                ds = dcmread(path, stop_before_pixels=True,
+                             specific_tags=['StudyInstanceUID', 'InstanceNumber'])
+            except Exception as e:
+                log_to_file('EXPORT ERROR: {}: {}'.format(path, e))
+                continue
+            studies[ds.get('StudyInstanceUID', '')].append(
+                (int(ds.get('InstanceNumber') or 0), path))
+    return [[path for _, path in sorted(paths)] for paths in studies.values()]
+
+
+def _init_worker():
+    global _app
+    _app = QGuiApplication([])
+
+
+def export_study(paths: list, output: str, image_format: str = None) -> tuple:
+    """ Write report PDF and optionally tuned images of one study, (pdf, images) """
+    options = ImageOptions()
+    study = None
+    for path in paths:
+        image = decode(path)
+        if study is None:
+            study = PrintStudy(image.header)
+        study.items.append(PrintItem(ImagePyramid.from_arrays(image.levels),
+                                     image.image_info, options))
+
+    pdf_path = os.path.join(output, '{}.pdf'.format(study.name))
+    report.make(pdf_printer(pdf_path), study)
+    if image_format:
+        for number, item in enumerate(study.items, 1):
+            tune_qimage(item.image, options.brightness(), options.contrast(),
+                        options.sharpness()).save(
+                os.path.join(output, '{}_{}.{}'.format(study.name, number, image_format)))
+    return pdf_path, len(study.items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export DICOM studies to report PDFs')
+    parser.add_argument('source', help='directory of .dcm files, e.g. the spool directory')
+    parser.add_argument('output', help='directory for the reports')
+    parser.add_argument('--images', choices=('png', 'jpg'),
+                        help='also save every image tuned as printed')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes')
+    args = parser.parse_args()
+
+    # no display needed, inherited by the workers
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    start = time.perf_counter()
+    studies = find_studies(args.source)
+    exported = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        futures = [pool.submit(export_study, paths, args.output, args.images)
+                   for paths in studies]
+        for future in as_completed(futures):
+            try:
+                pdf_path, images = future.result()
+            except Exception as e:
+                log_to_file('EXPORT ERROR: {}'.format(e))
+                continue
+            exported += 1
+            print('{} images to {}'.format(images, pdf_path))
+    seconds = time.perf_counter() - start
+    print('{} of {} studies in {:.1f} s, {:.1f} studies/min'.format(
+        exported, len(studies), seconds, exported / seconds * 60))
+
+
+if __name__ == '__main__':
+    freeze_support()
+    main()
@@ -1,82 +1,157 @@
-from PySide6.QtCore import Qt, Slot
-from PySide6.QtGui import QPixmap
-from PySide6.QtWidgets import QGroupBox, QLabel, QLineEdit, QPushButton, QHBoxLayout, QVBoxLayout
+from concurrent.futures import Future
+from functools import partial
 
+from PySide6.QtCore import Qt, Slot, Signal, QObject, QSize
+
+from cine import FrameSource
+from decoder import DecodePipeline
+from imageoptions import ImageOptions
+from imagestore import store
 from optionsform import OptionsForm
 from settings import settings
-from tools import tune_qpixmap
+from tools import array_to_qimage, log_to_file
+from tune_cache import cache
 
 VIEW_IMAGE_WIDTH = int(settings.VIEW_IMAGE_WIDTH)
-BOX_FONT_SIZE = int(settings.BOX_FONT_SIZE)
 
 
-class ImageBox(QGroupBox):
+class ImageBox(QObject):
+    """
+    Received image of DicomImageList and how it is printed.
+    No widgets of its own, it is painted by imagedelegate.ImageBoxDelegate.
+    Pixels are owned by imagestore, the box holds views of them and the
+    tuned image shared with tune_cache.
+    """
+    changed = Signal()
+    # clip frame number, its array, from the decode pool
+    frame_decoded = Signal(int, object)
 
-    def __init__(self, pixmap: QPixmap, image_info: str):
+    def __init__(self, image_id: int, image_info: str, frames: FrameSource = None,
+                 decoder: DecodePipeline = None):
         super().__init__()
 
         self.image_info = image_info
-        self.setTitle(image_info)
-
-        self.setCheckable(True)
-        self.setChecked(True)
-        font = self.font()
-        font.setPixelSize(BOX_FONT_SIZE)
-        self.setFont(font)
-
-        self.pixmap = pixmap
-        self.options = OptionsForm(self.pixmap)
-
-        self.img = QLabel()
-        ratio = VIEW_IMAGE_WIDTH / float(pixmap.width())
-        height = int(float(pixmap.height()) * float(ratio))
-        self.img.resize(VIEW_IMAGE_WIDTH, height)
-        self.scaled_pixmap = self.pixmap.scaled(self.img.size(),
-                                                Qt.KeepAspectRatio,
-                                                Qt.SmoothTransformation)
+        self.checked = True
+        self.comment = ''
+
+        # imagestore handle, tune_cache key of the frame shown is (image_id, shown_frame)
+        self.image_id = image_id
+        self.pyramid = store.pyramid(image_id)
+        self.image = self.pyramid.image
+
+        # cine clip: frame chosen on the slider, frame shown and frames chosen for printing
+        self.frames = frames
+        self.frame = 0
+        self.shown_frame = 0
+        self.print_frames = {0}
+        # frames are decoded on its pool, on the GUI thread without it
+        self.decoder = decoder
+        self.frame_future = None
+        # noinspection PyUnresolvedReferences
+        self.frame_decoded.connect(self.set_frame)
+
+        ratio = VIEW_IMAGE_WIDTH / float(self.image.width())
+        height = int(float(self.image.height()) * float(ratio))
+        # the preview level is this size already
+        self.scaled_image = self.pyramid.nearest(QSize(VIEW_IMAGE_WIDTH, height)).scaled(
+            VIEW_IMAGE_WIDTH, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        # OptionsForm is made when '...' is clicked
+        self.options = ImageOptions()
+        self.tuned_image = self.scaled_image
         self.draw()
 
-        self.comment = QLineEdit(self)
-
-        self.options_button = QPushButton('...', self)
-        self.options_button.setFont(font)
-        self.options_button.setFlat(True)
-        self.options_button.setFixedWidth(20)
-
-        self.h_layout = QHBoxLayout()
-        self.h_layout.addWidget(self.comment)
-        self.h_layout.addWidget(self.options_button)
-
-        self.vertical_layout = QVBoxLayout(self)
-        self.vertical_layout.addWidget(self.img)
-        self.vertical_layout.addLayout(self.h_layout)
-        self.setLayout(self.vertical_layout)
-
-        self.setFixedWidth(self.contentsMargins().left() +
-                           self.contentsMargins().right() +
-                           self.img.width() +
-                           (self.vertical_layout.spacing() * 2))
-        self.setFixedHeight(self.contentsMargins().top() +
-                            self.contentsMargins().bottom() +
-                            self.img.height() + self.comment.height() +
-                            (self.vertical_layout.spacing() * 3))
+    def isChecked(self) -> bool:
+        return self.checked
 
-        self.options_button.clicked.connect(self.on_options_button_clicked)
-        self.options.redraw.connect(self.redraw_handler)
+    def setChecked(self, checked: bool):
+        self.checked = checked
+        self.changed.emit()
 
     def change(self):
         self.setChecked(not self.isChecked())
 
+    def set_comment(self, comment: str):
+        self.comment = comment
+        self.changed.emit()
+
     def draw(self):
-        self.img.setPixmap(tune_qpixmap(self.scaled_pixmap,
-                                        self.options.brightness(),
-                                        self.options.contrast(),
-                                        self.options.sharpness()))
+        # painted as is, a QPixmap would be a 32 bit copy of it
+        self.tuned_image = cache.tune((self.image_id, self.shown_frame), self.scaled_image,
+                                      self.options.brightness(),
+                                      self.options.contrast(),
+                                      self.options.sharpness())
+        self.changed.emit()
+
+    @Slot(int)
+    def show_frame(self, frame: int):
+        """ The frame shown now stays until *frame* is decoded """
+        self.frame = frame
+        if self.frame_future is not None:
+            self.frame_future.cancel()
+        if self.decoder is None:
+            self.set_frame(frame, self.frames[frame])
+            return
+        self.frame_future = self.decoder.submit_frame(self.frames, frame)
+        self.frame_future.add_done_callback(partial(self._frame_done, frame))
+        self.changed.emit()
+
+    def _frame_done(self, frame: int, future: Future):
+        """ Runs in the decode pool """
+        if future.cancelled():
+            return
+        try:
+            array = future.result()
+        except Exception as e:
+            log_to_file('DECODE ERROR: frame {} of {}: {}'.format(frame + 1, self.image_info, e))
+            return
+        # noinspection PyUnresolvedReferences
+        self.frame_decoded.emit(frame, array)
+
+    @Slot(int, object)
+    def set_frame(self, frame: int, array):
+        if frame != self.frame:
+            # the slider has moved on
+            return
+        # decoded by other process, see DECODE_POOL
+        self.frames.keep(frame, array)
+        self.shown_frame = frame
+        self.image = array_to_qimage(array)
+        self.scaled_image = self.image.scaled(self.tuned_image.size(),
+                                              Qt.KeepAspectRatio,
+                                              Qt.SmoothTransformation)
+        self.draw()
 
-    def on_options_button_clicked(self):
-        if self.options.exec():
-            self.draw()
+    @Slot(bool)
+    def choose_frame(self, checked: bool):
+        if checked:
+            self.print_frames.add(self.frame)
+        else:
+            self.print_frames.discard(self.frame)
+        self.changed.emit()
+
+    def print_images(self):
+        """ (ImagePyramid, image_info) of every frame chosen for printing """
+        if self.frames is None:
+            yield self.pyramid, self.image_info
+            return
+        yield from self.frames.print_images(sorted(self.print_frames), self.image_info)
+
+    def comment_text(self) -> str:
+        return self.comment
+
+    def options_changed(self):
+        # images tuned with the former options are not drawn again
+        cache.discard(self.image_id)
+        self.draw()
+
+    def load_options(self):
+        """ Saved options, as settings_changed asks """
+        self.options.load()
+        self.options_changed()
 
     @Slot()
-    def redraw_handler(self):
-        self.draw()
+    def edit_options(self):
+        form = OptionsForm(self.scaled_image, (self.image_id, self.shown_frame), self.options)
+        if form.exec():
+            self.options.set(form.brightness(), form.contrast(), form.sharpness())
+            self.options_changed()
@@ -0,0 +1,221 @@
+from PySide6.QtCore import Qt, QRect, QSize, QEvent, QModelIndex, Slot
+from PySide6.QtGui import QFont, QFontMetrics, QPainter
+from PySide6.QtWidgets import (QStyledItemDelegate, QStyle, QStyleOptionViewItem, QStyleOptionButton,
+                               QStyleOptionFrame, QStyleOptionSlider, QApplication, QWidget, QLabel,
+                               QLineEdit, QPushButton, QSlider, QCheckBox, QHBoxLayout, QVBoxLayout)
+
+from imagebox import ImageBox
+from settings import settings
+
+BOX_FONT_SIZE = int(settings.BOX_FONT_SIZE)
+
+# item data role of the ImageBox itself
+BOX_ROLE = Qt.UserRole
+# spacing inside the box, pixels
+MARGIN = 4
+OPTIONS_BUTTON_WIDTH = 20
+
+
+def _box_font() -> QFont:
+    font = QFont(QApplication.font())
+    font.setPixelSize(BOX_FONT_SIZE)
+    return font
+
+
+class BoxGeometry:
+    """ Geometry of ImageBox parts inside the item rect """
+
+    def __init__(self, rect: QRect, box: ImageBox, fm: QFontMetrics):
+        row_height = fm.height() + MARGIN * 2
+        inner = rect.adjusted(MARGIN, MARGIN, -MARGIN, -MARGIN)
+        self.header = QRect(inner.left(), inner.top(), inner.width(), row_height)
+        self.image = QRect(inner.left(), self.header.bottom() + 1 + MARGIN,
+                           box.tuned_image.width(), box.tuned_image.height())
+        rows = 1 if box.frames is None else 2
+        self.controls = QRect(inner.left(), self.image.bottom() + 1 + MARGIN,
+                              inner.width(), row_height * rows + MARGIN * (rows - 1))
+        self.comment = QRect(self.controls.left(), self.controls.bottom() + 1 - row_height,
+                             self.controls.width() - OPTIONS_BUTTON_WIDTH - MARGIN, row_height)
+        self.options_button = QRect(self.comment.right() + 1 + MARGIN, self.comment.top(),
+                                    OPTIONS_BUTTON_WIDTH, row_height)
+        # cine clip: slider, frame number, 'Print'
+        self.frame_label_width = fm.horizontalAdvance('000/000') + MARGIN
+        self.print_width = fm.horizontalAdvance('Print') + fm.height() + MARGIN * 2
+        self.slider = QRect(self.controls.left(), self.controls.top(),
+                            self.controls.width() - self.frame_label_width -
+                            self.print_width - MARGIN * 2, row_height)
+        self.frame_label = QRect(self.slider.right() + 1 + MARGIN, self.slider.top(),
+                                 self.frame_label_width, row_height)
+        self.print_check = QRect(self.frame_label.right() + 1 + MARGIN, self.slider.top(),
+                                 self.print_width, row_height)
+
+    @staticmethod
+    def size(box: ImageBox, fm: QFontMetrics) -> QSize:
+        row_height = fm.height() + MARGIN * 2
+        rows = 1 if box.frames is None else 2
+        return QSize(box.tuned_image.width() + MARGIN * 2,
+                     row_height * (rows + 1) + box.tuned_image.height() + MARGIN * (rows + 3))
+
+
+class ImageBoxEditor(QWidget):
+    """ Real widgets over the controls of the one ImageBox being edited """
+
+    def __init__(self, box: ImageBox, font: QFont, parent: QWidget):
+        super().__init__(parent)
+        self.box = box
+        self.setAutoFillBackground(True)
+        self.setFont(font)
+
+        self.vertical_layout = QVBoxLayout(self)
+        self.vertical_layout.setContentsMargins(0, 0, 0, 0)
+        self.vertical_layout.setSpacing(MARGIN)
+        if box.frames is not None:
+            fm = QFontMetrics(font)
+            self.sldFrame = QSlider(Qt.Horizontal, self)
+            self.sldFrame.setMaximum(len(box.frames) - 1)
+            self.sldFrame.setValue(box.frame)
+            self.lblFrame = QLabel(self)
+            self.lblFrame.setFixedWidth(fm.horizontalAdvance('000/000') + MARGIN)
+            self.chkFrame = QCheckBox('Print', self)
+            self.frame_layout = QHBoxLayout()
+            self.frame_layout.addWidget(self.sldFrame)
+            self.frame_layout.addWidget(self.lblFrame)
+            self.frame_layout.addWidget(self.chkFrame)
+            self.vertical_layout.addLayout(self.frame_layout)
+            self.show_frame_state()
+            self.sldFrame.valueChanged.connect(self.show_frame)
+            self.chkFrame.toggled.connect(box.choose_frame)
+
+        self.comment = QLineEdit(box.comment, self)
+        self.options_button = QPushButton('...', self)
+        self.options_button.setFlat(True)
+        self.options_button.setFixedWidth(OPTIONS_BUTTON_WIDTH)
+        self.h_layout = QHBoxLayout()
+        self.h_layout.addWidget(self.comment)
+        self.h_layout.addWidget(self.options_button)
+        self.vertical_layout.addLayout(self.h_layout)
+
+        self.comment.textEdited.connect(box.set_comment)
+        self.options_button.clicked.connect(box.edit_options)
+
+    def show_frame_state(self):
+        self.lblFrame.setText('{}/{}'.format(self.box.frame + 1, len(self.box.frames)))
+        self.chkFrame.blockSignals(True)
+        self.chkFrame.setChecked(self.box.frame in self.box.print_frames)
+        self.chkFrame.blockSignals(False)
+
+    @Slot(int)
+    def show_frame(self, frame: int):
+        self.box.show_frame(frame)
+        self.show_frame_state()
+
+
+class ImageBoxDelegate(QStyledItemDelegate):
+    """
+    Paints ImageBoxes of DicomImageList: check box with title, tuned image,
+    clip frame controls and comment. Only the item being edited gets
+    real widgets, see ImageBoxEditor.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.font = _box_font()
+        self.fm = QFontMetrics(self.font)
+
+    def sizeHint(self, option: QStyleOptionViewItem, index: QModelIndex) -> QSize:
+        return BoxGeometry.size(index.data(BOX_ROLE), self.fm)
+
+    def paint(self, painter: QPainter, option: QStyleOptionViewItem, index: QModelIndex):
+        box = index.data(BOX_ROLE)
+        widget = option.widget
+        style = widget.style() if widget else QApplication.style()
+        geometry = BoxGeometry(option.rect, box, self.fm)
+        enabled = QStyle.State_Enabled if box.isChecked() else QStyle.State_None
+
+        painter.save()
+        painter.setFont(self.font)
+
+        frame = QStyleOptionFrame()
+        frame.initFrom(widget)
+        frame.rect = option.rect
+        frame.lineWidth = 1
+        style.drawPrimitive(QStyle.PE_FrameGroupBox, frame, painter, widget)
+        if option.state & QStyle.State_Selected:
+            painter.setPen(option.palette.highlight().color())
+            painter.drawRect(option.rect.adjusted(0, 0, -1, -1))
+
+        check = QStyleOptionButton()
+        check.initFrom(widget)
+        check.rect = geometry.header
+        check.fontMetrics = self.fm
+        check.text = self.fm.elidedText(box.image_info, Qt.ElideRight,
+                                        geometry.header.width() - self.fm.height() - MARGIN)
+        check.state = QStyle.State_Enabled | (QStyle.State_On if box.isChecked()
+                                              else QStyle.State_Off)
+        style.drawControl(QStyle.CE_CheckBox, check, painter, widget)
+
+        if not box.isChecked():
+            # as disabled QGroupBox contents
+            painter.setOpacity(0.5)
+        painter.drawImage(geometry.image.topLeft(), box.tuned_image)
+
+        if box.frames is not None:
+            slider = QStyleOptionSlider()
+            slider.initFrom(widget)
+            slider.state = enabled
+            slider.rect = geometry.slider
+            slider.orientation = Qt.Horizontal
+            slider.minimum = 0
+            slider.maximum = len(box.frames) - 1
+            slider.sliderPosition = slider.sliderValue = box.frame
+            slider.subControls = QStyle.SC_SliderGroove | QStyle.SC_SliderHandle
+            style.drawComplexControl(QStyle.CC_Slider, slider, painter, widget)
+            painter.drawText(geometry.frame_label, Qt.AlignLeft | Qt.AlignVCenter,
+                             '{}/{}'.format(box.frame + 1, len(box.frames)))
+            print_check = QStyleOptionButton()
+            print_check.initFrom(widget)
+            print_check.rect = geometry.print_check
+            print_check.fontMetrics = self.fm
+            print_check.text = 'Print'
+            print_check.state = enabled | (QStyle.State_On if box.frame in box.print_frames
+                                           else QStyle.State_Off)
+            style.drawControl(QStyle.CE_CheckBox, print_check, painter, widget)
+
+        comment = QStyleOptionFrame()
+        comment.initFrom(widget)
+        comment.state = enabled | QStyle.State_Sunken
+        comment.rect = geometry.comment
+        comment.lineWidth = style.pixelMetric(QStyle.PM_DefaultFrameWidth)
+        style.drawPrimitive(QStyle.PE_PanelLineEdit, comment, painter, widget)
+        painter.drawText(geometry.comment.adjusted(MARGIN, 0, -MARGIN, 0),
+                         Qt.AlignLeft | Qt.AlignVCenter,
+                         self.fm.elidedText(box.comment, Qt.ElideRight,
+                                            geometry.comment.width() - MARGIN * 2))
+        painter.drawText(geometry.options_button, Qt.AlignCenter, '...')
+        painter.restore()
+
+    def editorEvent(self, event: QEvent, model, option: QStyleOptionViewItem,
+                    index: QModelIndex) -> bool:
+        if (event.type() == QEvent.MouseButtonRelease and
+                event.button() == Qt.LeftButton):
+            box = index.data(BOX_ROLE)
+            geometry = BoxGeometry(option.rect, box, self.fm)
+            if geometry.header.contains(event.position().toPoint()):
+                state = Qt.Unchecked if box.isChecked() else Qt.Checked
+                return model.setData(index, state, Qt.CheckStateRole)
+        return False
+
+    def createEditor(self, parent: QWidget, option: QStyleOptionViewItem,
+                     index: QModelIndex) -> QWidget:
+        return ImageBoxEditor(index.data(BOX_ROLE), self.font, parent)
+
+    def setEditorData(self, editor: ImageBoxEditor, index: QModelIndex):
+        if editor.comment.text() != index.data(Qt.EditRole):
+            editor.comment.setText(index.data(Qt.EditRole))
+
+    def setModelData(self, editor: ImageBoxEditor, model, index: QModelIndex):
+        model.setData(index, editor.comment.text(), Qt.EditRole)
+
+    def updateEditorGeometry(self, editor: ImageBoxEditor, option: QStyleOptionViewItem,
+                             index: QModelIndex):
+        editor.setGeometry(BoxGeometry(option.rect, index.data(BOX_ROLE), self.fm).controls)
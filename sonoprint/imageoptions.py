@@ -0,0 +1,33 @@
+from settings import settings
+
+
+class ImageOptions:
+    """
+    Brightness, contrast and sharpness of an ImageBox, the saved ones to
+    begin with. OptionsForm is made only while they are edited, print
+    jobs freeze a copy.copy() of them.
+    """
+    __slots__ = ('_brightness', '_contrast', '_sharpness')
+
+    def __init__(self):
+        self.load()
+
+    def load(self):
+        """ Saved values """
+        self.set(int(settings.SAVED_IMAGE_BRIGHTNESS),
+                 int(settings.SAVED_IMAGE_CONTRAST),
+                 int(settings.SAVED_IMAGE_SHARPNESS))
+
+    def set(self, brightness: int, contrast: int, sharpness: int):
+        self._brightness = brightness
+        self._contrast = contrast
+        self._sharpness = sharpness
+
+    def brightness(self) -> int:
+        return self._brightness
+
+    def contrast(self) -> int:
+        return self._contrast
+
+    def sharpness(self) -> int:
+        return self._sharpness
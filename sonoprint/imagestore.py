@@ -0,0 +1,57 @@
+from threading import Lock
+
+from pyramid import ImagePyramid
+from tune_cache import cache, new_image_id
+
+
+class ImageStore:
+    """
+    Owner of the pixel buffers of received images: pyramid levels by
+    image id. ImageBox and OptionsForm hold the id and QImage views of
+    these arrays, tuned images are shared with tune_cache.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # image id: arrays of the pyramid levels
+        self.images = {}
+
+    def add(self, levels: list) -> int:
+        image_id = new_image_id()
+        with self.lock:
+            self.images[image_id] = levels
+        return image_id
+
+    def pyramid(self, image_id: int) -> ImagePyramid:
+        """ Views of the stored levels, no pixels are copied """
+        with self.lock:
+            return ImagePyramid.from_arrays(self.images[image_id])
+
+    def release(self, image_id: int):
+        """ The buffers are freed when the last view is gone """
+        with self.lock:
+            self.images.pop(image_id, None)
+        cache.discard(image_id)
+
+    def held(self, image_id: int) -> tuple:
+        """ Bytes of (pyramid levels, tuned images) of the image """
+        with self.lock:
+            levels = sum(level.nbytes for level in self.images.get(image_id, ()))
+        return levels, cache.held(image_id)
+
+    def report(self) -> str:
+        """ Bytes held per image of the session """
+        with self.lock:
+            image_ids = list(self.images)
+        if not image_ids:
+            return 'Image store is empty'
+        held = [self.held(image_id) for image_id in image_ids]
+        levels = sum(level for level, _ in held)
+        tuned = sum(tuned for _, tuned in held)
+        return 'Image store: {} images, levels {:.1f} MB, tuned {:.1f} MB, {:.0f} KB per image'. \
+            format(len(held), levels / 2 ** 20, tuned / 2 ** 20,
+                   (levels + tuned) / len(held) / 2 ** 10)
+
+
+# shared by the whole process
+store = ImageStore()
@@ -1,10 +1,14 @@
-from PySide6.QtCore import Qt, Slot, Signal
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import Qt, Slot, Signal, QTimer
 from PySide6.QtWidgets import (QVBoxLayout, QHBoxLayout, QLabel, QSlider, QDialog, QPushButton, QApplication)
-from PySide6.QtGui import QPixmap, QIcon
-from PIL import ImageQt
+from PySide6.QtGui import QImage, QPixmap, QIcon, QShowEvent, QHideEvent
 
+from imageoptions import ImageOptions
+from pyramid import THUMBNAIL_WIDTH
 from settings import settings
-from tools import tune
+from tools import tune_qimage
+from tune_cache import cache
 
 # loading settings:
 
@@ -12,13 +16,27 @@ VIEW_IMAGE_WIDTH = int(settings.VIEW_IMAGE_WIDTH)
 DEFAULT_IMAGE_BRIGHTNESS = int(settings.DEFAULT_IMAGE_BRIGHTNESS)
 DEFAULT_IMAGE_CONTRAST = int(settings.DEFAULT_IMAGE_CONTRAST)
 DEFAULT_IMAGE_SHARPNESS = int(settings.DEFAULT_IMAGE_SHARPNESS)
+# The image is rendered this long (ms) after the last slider move
+OPTIONS_PREVIEW_INTERVAL = int(settings.OPTIONS_PREVIEW_INTERVAL)
 
+# renders of the shown OptionsForm, off the GUI thread
+_render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='options')
 
-class OptionsForm(QDialog):
-    redraw = Signal()
 
-    def __init__(self, pixmap: QPixmap):
+class OptionsForm(QDialog):
+    """
+    Sliders of ImageOptions with the image tuned by them. Slider moves are
+    rendered once they stop for OPTIONS_PREVIEW_INTERVAL ms, at quarter
+    resolution while a slider is dragged and in full when it is released.
+    Renders made stale by newer values are cancelled or dropped.
+    """
+    # render number, tuned image
+    rendered = Signal(int, QImage)
+
+    def __init__(self, image: QImage, image_id, options: ImageOptions):
         super().__init__()
+        # tune_cache key of *image*
+        self.image_id = image_id
 
         self.saved_image_brightness = int(settings.SAVED_IMAGE_BRIGHTNESS)
         self.saved_image_contrast = int(settings.SAVED_IMAGE_CONTRAST)
@@ -27,23 +45,26 @@ class OptionsForm(QDialog):
         self.setWindowTitle('Sonoprint - Setting image characteristics')
         self.setWindowIcon(QIcon(':/icons/sonoprint.ico'))
 
-        ratio = VIEW_IMAGE_WIDTH / float(pixmap.width())
-        height = int(float(pixmap.height()) * float(ratio))
+        ratio = VIEW_IMAGE_WIDTH / float(image.width())
+        height = int(float(image.height()) * float(ratio))
 
         self.img = QLabel()
         self.img.resize(VIEW_IMAGE_WIDTH, height)
 
-        self.pixmap = pixmap.scaled(self.img.size(),
-                                    Qt.KeepAspectRatio,
-                                    Qt.SmoothTransformation)
-        self.tmp_pil_img = ImageQt.fromqpixmap(self.pixmap)
+        self.image = image.scaled(self.img.size(),
+                                  Qt.KeepAspectRatio,
+                                  Qt.SmoothTransformation)
+        # drafts, not cached
+        self.thumbnail = self.image.scaledToWidth(THUMBNAIL_WIDTH, Qt.SmoothTransformation)
+        # the layout does not jump between drafts and full renders
+        self.img.setFixedSize(self.image.size())
 
         self.lblBrightness = QLabel()
         self.lblBrightness.setText('Brightness')
         self.lblBrightness.setFixedWidth(60)
         self.sldBrightness = QSlider()
         self.sldBrightness.setMaximum(500)
-        self.sldBrightness.setValue(self.saved_image_brightness)
+        self.sldBrightness.setValue(options.brightness())
         self.sldBrightness.setOrientation(Qt.Horizontal)
         self.sldBrightness.setTickPosition(QSlider.TicksBothSides)
         self.lytBrightness = QHBoxLayout()
@@ -55,7 +76,7 @@ class OptionsForm(QDialog):
         self.lblContrast.setFixedWidth(60)
         self.sldContrast = QSlider()
         self.sldContrast.setMaximum(500)
-        self.sldContrast.setValue(self.saved_image_contrast)
+        self.sldContrast.setValue(options.contrast())
         self.sldContrast.setOrientation(Qt.Horizontal)
         self.sldContrast.setTickPosition(QSlider.TicksBothSides)
         self.lytContrast = QHBoxLayout()
@@ -68,7 +89,7 @@ class OptionsForm(QDialog):
         self.sldSharpness = QSlider()
         self.sldSharpness.setMaximum(400)
         self.sldSharpness.setMinimum(-100)
-        self.sldSharpness.setValue(self.saved_image_sharpness)
+        self.sldSharpness.setValue(options.sharpness())
         self.sldSharpness.setOrientation(Qt.Horizontal)
         self.sldSharpness.setTickPosition(QSlider.TicksBothSides)
         self.lytSharpness = QHBoxLayout()
@@ -95,9 +116,20 @@ class OptionsForm(QDialog):
         self.vertical_layout.addLayout(self.lytButtons)
         self.setLayout(self.vertical_layout)
 
-        self.sldBrightness.valueChanged.connect(self.calibrate_image)
-        self.sldContrast.valueChanged.connect(self.calibrate_image)
-        self.sldSharpness.valueChanged.connect(self.calibrate_image)
+        # number of the last render asked, older ones are stale
+        self.render_number = 0
+        self.render = None
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(OPTIONS_PREVIEW_INTERVAL)
+        # noinspection PyUnresolvedReferences
+        self.render_timer.timeout.connect(self.calibrate_image)
+        # noinspection PyUnresolvedReferences
+        self.rendered.connect(self.show_render)
+
+        for slider in (self.sldBrightness, self.sldContrast, self.sldSharpness):
+            slider.valueChanged.connect(self.ask_render)
+            slider.sliderReleased.connect(self.ask_render)
         self.btnReset.clicked.connect(self.reset_sliders)
         self.btnLoad.clicked.connect(self.load)
         self.btnApply.clicked.connect(self.apply)
@@ -108,11 +140,59 @@ class OptionsForm(QDialog):
 
         self.btnApply.setDefault(True)
 
+    def showEvent(self, event: QShowEvent):
         self.calibrate_image()
+        super().showEvent(event)
+
+    def hideEvent(self, event: QHideEvent):
+        self.render_timer.stop()
+        self.cancel_render()
+        # the label pixmap is a 32 bit copy of the image, kept only while shown
+        self.img.clear()
+        super().hideEvent(event)
+
+    def cancel_render(self):
+        """ A render waiting for the worker is cancelled, a running one is dropped """
+        self.render_number += 1
+        if self.render is not None:
+            self.render.cancel()
+            self.render = None
+
+    @Slot()
+    def ask_render(self):
+        """ Slider moves are rendered when they stop """
+        self.render_timer.start()
 
+    @Slot()
     def calibrate_image(self):
-        pixmap = tune(self.tmp_pil_img, self.sldBrightness.value(),
-                      self.sldContrast.value(), self.sldSharpness.value())
+        if not self.isVisible():
+            return
+        self.cancel_render()
+        dragged = any(slider.isSliderDown() for slider in
+                      (self.sldBrightness, self.sldContrast, self.sldSharpness))
+        self.render = _render_pool.submit(self.render_image, self.render_number, dragged,
+                                          self.sldBrightness.value(),
+                                          self.sldContrast.value(),
+                                          self.sldSharpness.value())
+
+    def render_image(self, number: int, draft: bool, brightness, contrast, sharpness):
+        """ Runs in _render_pool """
+        if number != self.render_number:
+            return
+        if draft:
+            image = tune_qimage(self.thumbnail, brightness, contrast, sharpness)
+        else:
+            image = cache.tune(self.image_id, self.image, brightness, contrast, sharpness)
+        # noinspection PyUnresolvedReferences
+        self.rendered.emit(number, image)
+
+    @Slot(int, QImage)
+    def show_render(self, number: int, image: QImage):
+        if number != self.render_number:
+            return
+        pixmap = QPixmap.fromImage(image)
+        if image.size() != self.image.size():
+            pixmap = pixmap.scaled(self.image.size(), Qt.KeepAspectRatio)
         self.img.setPixmap(pixmap)
 
     def reset_sliders(self):
@@ -154,4 +234,3 @@ class OptionsForm(QDialog):
             self.saved_image_contrast = int(settings.SAVED_IMAGE_CONTRAST)
             self.saved_image_sharpness = int(settings.SAVED_IMAGE_SHARPNESS)
             self.load()
-            self.redraw.emit()
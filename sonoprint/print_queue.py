@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from datetime import datetime
+from time import perf_counter
+
+from PySide6.QtCore import QObject, Signal
+from PySide6.QtPrintSupport import QPrinter
+
+import report
+from imageoptions import ImageOptions
+from pyramid import ImagePyramid
+from tools import log_to_file
+from tune_cache import new_image_id
+
+# print job states
+QUEUED = 'queued'
+RENDERING = 'rendering'
+SPOOLING = 'spooling'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class PrintItem:
+    """ Received image as report.make sees ImageBox, without widgets """
+
+    def __init__(self, pyramid: ImagePyramid, image_info: str, options: ImageOptions,
+                 comment: str = ''):
+        self.pyramid = pyramid
+        self.image = pyramid.image
+        self.image_info = image_info
+        self.options = options
+        self.comment = comment
+        # cine clip (cine.FrameSource) and its frames chosen for printing
+        self.frames = None
+        self.print_frames = []
+        # see tune_cache
+        self.image_id = new_image_id()
+
+    @classmethod
+    def frozen(cls, box) -> 'PrintItem':
+        """
+        Copy of ImageBox as it is now: chosen frames, comment and options.
+        Nothing is decoded here, on the GUI thread: clip frames are decoded
+        by the print worker.
+        """
+        item = cls(box.pyramid, box.image_info, copy(box.options), box.comment_text())
+        if box.frames is not None:
+            # the mapped spooled file stays readable when the study is cleared
+            _ = box.frames.dataset
+            item.frames = box.frames
+            item.print_frames = sorted(box.print_frames)
+        # print images tuned for the box are reused
+        item.image_id = box.image_id
+        return item
+
+    @staticmethod
+    def isChecked() -> bool:
+        return True
+
+    def print_images(self):
+        if self.frames is None:
+            return iter([(self.pyramid, self.image_info)])
+        return self.frames.print_images(self.print_frames, self.image_info)
+
+    def comment_text(self) -> str:
+        return self.comment
+
+
+class PrintJob:
+    """
+    Checked images of DicomImageList or print_server.PrintStudy frozen
+    for printing, report.make sees the job as the viewer
+    """
+
+    def __init__(self, viewer, printer: QPrinter):
+        self.clinic = viewer.clinic
+        self.patient_id = viewer.patient_id
+        self.study_info = viewer.study_info
+        self.device_info = viewer.device_info
+        self.items = [PrintItem.frozen(box) for box in viewer.boxes() if box.isChecked()]
+        self.printer = printer
+        # set by PrintQueue
+        self.number = 0
+        self.state = QUEUED
+        # when every state started
+        self.times = {QUEUED: perf_counter()}
+
+    def boxes(self):
+        return iter(self.items)
+
+    def set_state(self, state: str):
+        self.times[state] = perf_counter()
+        self.state = state
+
+    def timings(self) -> str:
+        """ Seconds spent in every state so far """
+        times = sorted(self.times.items(), key=lambda item: item[1])
+        ends = [time for _, time in times[1:]] + [perf_counter()]
+        return ', '.join('{} {:.1f} s'.format(state, end - start)
+                         for (state, start), end in zip(times, ends)
+                         if state not in (DONE, FAILED))
+
+    def status(self) -> str:
+        if self.state in (DONE, FAILED):
+            return '#{} {}: {}'.format(self.number, self.state, self.timings())
+        return '#{} {} {:.1f} s'.format(self.number, self.state,
+                                        perf_counter() - self.times[self.state])
+
+
+class PrintQueue(QObject):
+    """
+    Renders and spools print jobs one by one on a worker thread, so the
+    GUI keeps receiving images meanwhile. *changed* is emitted, from the
+    worker too, whenever a job changes its state.
+    """
+    changed = Signal()
+
+    def __init__(self):
+        super().__init__()
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='print')
+        self.jobs = []
+        self.count = 0
+
+    def submit(self, job: PrintJob):
+        self.count += 1
+        job.number = self.count
+        # finished jobs are shown until the next one comes
+        self.jobs = [j for j in self.jobs if j.state not in (DONE, FAILED)] + [job]
+        self.pool.submit(self._print, job)
+        # noinspection PyUnresolvedReferences
+        self.changed.emit()
+
+    def _set_state(self, job: PrintJob, state: str):
+        job.set_state(state)
+        # noinspection PyUnresolvedReferences
+        self.changed.emit()
+
+    def _print(self, job: PrintJob):
+        self._set_state(job, RENDERING)
+        try:
+            report.make(job.printer, job, spooling=lambda: self._set_state(job, SPOOLING))
+        except Exception as e:
+            log_to_file('PRINT ERROR: job #{}: {}'.format(job.number, e))
+            self._set_state(job, FAILED)
+            return
+        self._set_state(job, DONE)
+        print('{}: {} images of {} printed to {}, {}'.
+              format(datetime.now(), len(job.items), job.study_info,
+                     job.printer.outputFileName() or job.printer.printerName(),
+                     job.timings()))
+
+    def status(self) -> str:
+        if not self.jobs:
+            return 'Print queue is empty'
+        return 'Print: {}'.format(', '.join(job.status() for job in self.jobs))
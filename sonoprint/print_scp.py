@@ -0,0 +1,282 @@
+from datetime import datetime
+from threading import Lock
+
+import numpy
+from PySide6.QtCore import QObject, Signal
+from pydicom import Dataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+from pynetdicom import evt
+from pynetdicom.events import Event
+
+from imageoptions import ImageOptions
+from print_queue import PrintItem
+from pyramid import ImagePyramid
+from scp import ae_title_str
+from settings import settings
+from tools import array_to_qimage, log_to_file
+
+# loading settings:
+# 1 - scanners can print films to us as to a DICOM printer
+DICOM_PRINT_SCP = int(settings.DICOM_PRINT_SCP)
+
+BASIC_GRAYSCALE_PRINT_MANAGEMENT_META = '1.2.840.10008.5.1.1.9'
+BASIC_FILM_SESSION = '1.2.840.10008.5.1.1.1'
+BASIC_FILM_BOX = '1.2.840.10008.5.1.1.2'
+BASIC_GRAYSCALE_IMAGE_BOX = '1.2.840.10008.5.1.1.4'
+PRINTER = '1.2.840.10008.5.1.1.16'
+
+N_CREATE_RQ = 0x0140
+# N-ACTION Action Type ID of Film Session and Film Box
+ACTION_PRINT = 1
+
+SUCCESS = 0x0000
+NO_SUCH_SOP_CLASS = 0x0118
+NO_SUCH_SOP_INSTANCE = 0x0112
+INVALID_ATTRIBUTE_VALUE = 0x0106
+NO_SUCH_ACTION = 0x0123
+PROCESSING_FAILURE = 0x0110
+# Film Box without Image Boxes printed (empty page)
+EMPTY_FILM_BOX = 0xB603
+# Film Session without Film Boxes printed
+EMPTY_FILM_SESSION = 0xC600
+
+
+def _box_count(image_display_format: str) -> int:
+    """ Number of image boxes of 'STANDARD\\C,R', 'ROW\\R1,R2,...' or 'COL\\C1,C2,...' """
+    layout, _, values = image_display_format.partition('\\')
+    numbers = [int(value) for value in values.split(',')]
+    if layout == 'STANDARD' and len(numbers) == 2:
+        return numbers[0] * numbers[1]
+    if layout in ('ROW', 'COL'):
+        return sum(numbers)
+    raise ValueError('Image Display Format {} is not supported'.format(image_display_format))
+
+
+def _image_box_array(image: Dataset) -> numpy.ndarray:
+    """ uint8 (rows, columns) of a Basic Grayscale Image Sequence item, native little endian """
+    dtype = numpy.uint8 if image.BitsAllocated == 8 else numpy.dtype('<u2')
+    array = numpy.frombuffer(image.PixelData, dtype, count=image.Rows * image.Columns)
+    array = array.reshape(image.Rows, image.Columns)
+    if image.BitsStored > 8:
+        # 12 bit print images
+        array = array >> (image.BitsStored - 8)
+    array = array.astype(numpy.uint8)
+    if image.PhotometricInterpretation == 'MONOCHROME1':
+        array = 255 - array
+    return array
+
+
+class FilmBox:
+    """ Film Box with its Image Boxes, image of every filled position """
+
+    def __init__(self, uid: str, boxes: int):
+        self.uid = uid
+        self.image_box_uids = [generate_uid() for _ in range(boxes)]
+        self.images = {}
+
+
+class FilmSession:
+    """ Film Session of one association: Film Boxes in creation order """
+
+    def __init__(self, uid: str, ae_title: str, address: str, label: str):
+        self.uid = uid
+        self.ae_title = ae_title
+        self.requestor = '{} ({})'.format(ae_title, address)
+        self.label = label
+        self.film_boxes = []
+        # Image Box SOP Instance UID: (FilmBox, image position)
+        self.image_boxes = {}
+
+
+class Film:
+    """ Printed Film Session or Film Box as report.make sees DicomImageList """
+
+    def __init__(self, session: FilmSession, film_boxes: list):
+        self.clinic = ''
+        self.patient_id = session.requestor
+        self.study_info = 'Film session {}from {}, {}'.format(
+            '{} '.format(session.label) if session.label else '', session.requestor,
+            datetime.now().strftime('%d.%m.%Y %H:%M'))
+        self.device_info = ''
+        # for file names
+        self.name = '{}_{}'.format(''.join(c for c in session.ae_title if c.isalnum()),
+                                   datetime.now().strftime('%Y%m%d'))
+        options = ImageOptions()
+        self.items = [PrintItem(ImagePyramid([array_to_qimage(film_box.images[position])]),
+                                'Film {}, image {}'.format(number, position), options)
+                      for number, film_box in enumerate(film_boxes, 1)
+                      for position in sorted(film_box.images)]
+
+    def boxes(self):
+        return iter(self.items)
+
+
+class PrintSCP(QObject):
+    """
+    Basic Grayscale Print Management Meta SOP Class on the AE of StoreSCP:
+    Film Session, Film Box and Image Box N-CREATE/N-SET/N-ACTION/N-DELETE
+    and Printer N-GET. Every association has its own Film Session, so
+    scanners print at once. Printed films are emitted as *film* for the
+    print queue, films are laid out by report.make, not by Image Display Format.
+    """
+    film = Signal(Film)
+
+    SOP_CLASSES = (BASIC_GRAYSCALE_PRINT_MANAGEMENT_META,)
+
+    def __init__(self):
+        super().__init__()
+        self.lock = Lock()
+        # association: FilmSession
+        self.sessions = {}
+
+    def handlers(self) -> list:
+        return [(evt.EVT_DIMSE_RECV, self.assign_instance_uid),
+                (evt.EVT_N_CREATE, self.handle_n_create),
+                (evt.EVT_N_SET, self.handle_n_set),
+                (evt.EVT_N_ACTION, self.handle_n_action),
+                (evt.EVT_N_DELETE, self.handle_n_delete),
+                (evt.EVT_N_GET, self.handle_n_get),
+                (evt.EVT_RELEASED, self.drop_session),
+                (evt.EVT_ABORTED, self.drop_session)]
+
+    @staticmethod
+    def assign_instance_uid(event: Event):
+        """
+        The SCP creates SOP Instance UIDs the SCU does not give, pynetdicom
+        answers N-CREATE with the UID of the request
+        """
+        command_set = event.message.command_set
+        if (command_set.CommandField == N_CREATE_RQ and
+                not command_set.get('AffectedSOPInstanceUID')):
+            command_set.AffectedSOPInstanceUID = generate_uid()
+
+    def session(self, event: Event) -> FilmSession:
+        with self.lock:
+            return self.sessions.get(event.assoc)
+
+    def drop_session(self, event: Event):
+        with self.lock:
+            self.sessions.pop(event.assoc, None)
+
+    def handle_n_create(self, event: Event) -> tuple:
+        request = event.request
+        attributes = event.attribute_list
+        if request.AffectedSOPClassUID == BASIC_FILM_SESSION:
+            session = FilmSession(request.AffectedSOPInstanceUID,
+                                  ae_title_str(event.assoc.requestor.ae_title),
+                                  event.assoc.requestor.address,
+                                  attributes.get('FilmSessionLabel', ''))
+            with self.lock:
+                # one Film Session per association
+                self.sessions[event.assoc] = session
+            return SUCCESS, attributes
+
+        if request.AffectedSOPClassUID == BASIC_FILM_BOX:
+            session = self.session(event)
+            if session is None:
+                return NO_SUCH_SOP_INSTANCE, None
+            try:
+                boxes = _box_count(attributes.ImageDisplayFormat)
+            except (AttributeError, ValueError) as e:
+                log_to_file('PRINT SCP ERROR: {}'.format(e))
+                return INVALID_ATTRIBUTE_VALUE, None
+            film_box = FilmBox(request.AffectedSOPInstanceUID, boxes)
+            session.film_boxes.append(film_box)
+            for position, uid in enumerate(film_box.image_box_uids, 1):
+                session.image_boxes[uid] = film_box, position
+            references = []
+            for uid in film_box.image_box_uids:
+                reference = Dataset()
+                reference.ReferencedSOPClassUID = BASIC_GRAYSCALE_IMAGE_BOX
+                reference.ReferencedSOPInstanceUID = uid
+                references.append(reference)
+            attributes.ReferencedImageBoxSequence = Sequence(references)
+            return SUCCESS, attributes
+
+        return NO_SUCH_SOP_CLASS, None
+
+    def handle_n_set(self, event: Event) -> tuple:
+        request = event.request
+        session = self.session(event)
+        if session is None:
+            return NO_SUCH_SOP_INSTANCE, None
+        if request.RequestedSOPClassUID == BASIC_GRAYSCALE_IMAGE_BOX:
+            if request.RequestedSOPInstanceUID not in session.image_boxes:
+                return NO_SUCH_SOP_INSTANCE, None
+            film_box, position = session.image_boxes[request.RequestedSOPInstanceUID]
+            modifications = event.modification_list
+            try:
+                image = modifications.BasicGrayscaleImageSequence[0]
+                film_box.images[position] = _image_box_array(image)
+            except Exception as e:
+                log_to_file('PRINT SCP ERROR: Image Box: {}'.format(e))
+                return INVALID_ATTRIBUTE_VALUE, None
+            return SUCCESS, None
+        if request.RequestedSOPClassUID in (BASIC_FILM_SESSION, BASIC_FILM_BOX):
+            # copies, medium, density and the like are up to our printer
+            return SUCCESS, None
+        return NO_SUCH_SOP_CLASS, None
+
+    def handle_n_action(self, event: Event) -> tuple:
+        request = event.request
+        session = self.session(event)
+        if session is None:
+            return NO_SUCH_SOP_INSTANCE, None
+        if request.ActionTypeID != ACTION_PRINT:
+            return NO_SUCH_ACTION, None
+
+        if request.RequestedSOPClassUID == BASIC_FILM_SESSION:
+            if not session.film_boxes:
+                return EMPTY_FILM_SESSION, None
+            film_boxes = session.film_boxes
+        elif request.RequestedSOPClassUID == BASIC_FILM_BOX:
+            film_boxes = [film_box for film_box in session.film_boxes
+                          if film_box.uid == request.RequestedSOPInstanceUID]
+            if not film_boxes:
+                return NO_SUCH_SOP_INSTANCE, None
+        else:
+            return NO_SUCH_SOP_CLASS, None
+
+        if not any(film_box.images for film_box in film_boxes):
+            return EMPTY_FILM_BOX, None
+        try:
+            film = Film(session, film_boxes)
+        except Exception as e:
+            log_to_file('PRINT SCP ERROR: {}'.format(e))
+            return PROCESSING_FAILURE, None
+        print('{}: film of {} images from {} queued for printing'.
+              format(event.timestamp, len(film.items), session.requestor))
+        # noinspection PyUnresolvedReferences
+        self.film.emit(film)
+        return SUCCESS, None
+
+    def handle_n_delete(self, event: Event) -> int:
+        request = event.request
+        session = self.session(event)
+        if session is None:
+            return NO_SUCH_SOP_INSTANCE
+        if request.RequestedSOPClassUID == BASIC_FILM_SESSION:
+            self.drop_session(event)
+        elif request.RequestedSOPClassUID == BASIC_FILM_BOX:
+            for film_box in session.film_boxes:
+                if film_box.uid == request.RequestedSOPInstanceUID:
+                    session.film_boxes.remove(film_box)
+                    for uid in film_box.image_box_uids:
+                        session.image_boxes.pop(uid, None)
+                    break
+            else:
+                return NO_SUCH_SOP_INSTANCE
+        else:
+            return NO_SUCH_SOP_CLASS
+        return SUCCESS
+
+    @staticmethod
+    def handle_n_get(event: Event) -> tuple:
+        if event.request.RequestedSOPClassUID != PRINTER:
+            return NO_SUCH_SOP_CLASS, None
+        printer = Dataset()
+        printer.PrinterStatus = 'NORMAL'
+        printer.PrinterStatusInfo = 'NORMAL'
+        printer.PrinterName = 'SONOPRINT'
+        return SUCCESS, printer
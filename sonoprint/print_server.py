@@ -0,0 +1,141 @@
+import os
+from datetime import datetime
+
+from PySide6.QtCore import QObject, QTimer, Slot
+from PySide6.QtPrintSupport import QPrinter, QPrinterInfo
+from pydicom import Dataset
+
+import spool
+from decoder import DecodePipeline, DecodedImage
+from imageoptions import ImageOptions
+from print_queue import PrintItem, PrintJob, PrintQueue
+from print_scp import PrintSCP, Film, DICOM_PRINT_SCP
+from pyramid import ImagePyramid
+from scp import StoreSCP, DICOM_SCP_PORT
+from settings import settings
+from tools import get_study_info
+
+# loading settings:
+# study is printed when no images come for this number of seconds
+PRINT_SERVER_IDLE_TIMEOUT = int(settings.PRINT_SERVER_IDLE_TIMEOUT)
+# printer name, empty - PDF files are written to PRINT_SERVER_PDF_DIR
+PRINT_SERVER_PRINTER = settings.PRINT_SERVER_PRINTER
+PRINT_SERVER_PDF_DIR = os.path.abspath(settings.PRINT_SERVER_PDF_DIR)
+
+
+def pdf_printer(path: str) -> QPrinter:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # QPrinter in PdfFormat is QPdfWriter with the API report.make uses
+    printer = QPrinter()
+    printer.setOutputFormat(QPrinter.PdfFormat)
+    printer.setOutputFileName(path)
+    return printer
+
+
+def _new_pdf_path(name: str) -> str:
+    """
+    *name*_HHMMSS.pdf in PRINT_SERVER_PDF_DIR, *name*_HHMMSS_2.pdf and so on
+    if taken. The file is created here, jobs of the same second never share it.
+    """
+    os.makedirs(PRINT_SERVER_PDF_DIR, exist_ok=True)
+    stem = '{}_{}'.format(name, datetime.now().strftime('%H%M%S'))
+    number = 1
+    while True:
+        path = os.path.join(PRINT_SERVER_PDF_DIR, '{}.pdf'.format(
+            stem if number == 1 else '{}_{}'.format(stem, number)))
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            return path
+        except FileExistsError:
+            number += 1
+
+
+def server_printer(name: str) -> QPrinter:
+    """ PRINT_SERVER_PRINTER or new PDF file *name*_HHMMSS.pdf in PRINT_SERVER_PDF_DIR """
+    if PRINT_SERVER_PRINTER:
+        return QPrinter(QPrinterInfo.printerInfo(PRINT_SERVER_PRINTER))
+    return pdf_printer(_new_pdf_path(name))
+
+
+class PrintStudy:
+    """ Images of one study as report.make sees DicomImageList """
+
+    def __init__(self, ds: Dataset):
+        self.clinic, self.patient_id, self.study_info, self.device_info = \
+            get_study_info(ds)
+        # for file names
+        self.name = '{}_{}_{}'.format(''.join(c for c in self.patient_id if c.isalnum()),
+                                      ds.StudyDate, ds.StudyTime)
+        self.items = []
+
+    def boxes(self):
+        return iter(self.items)
+
+
+class PrintServer(QObject):
+    """
+    Headless mode: the same SCPs and decode pipeline as the main window,
+    every study is printed when the scanner has been idle for
+    PRINT_SERVER_IDLE_TIMEOUT seconds or the next patient comes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.study = None
+        # spooled files of the received images
+        self.spooled = []
+        spool.purge()
+        self.options = ImageOptions()
+        self.print_queue = PrintQueue()
+
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(PRINT_SERVER_IDLE_TIMEOUT * 1000)
+        # noinspection PyUnresolvedReferences
+        self.idle_timer.timeout.connect(self.idle_handler)
+
+        self.pipeline = DecodePipeline()
+        # noinspection PyUnresolvedReferences
+        self.pipeline.decoded.connect(self.decoded_handler)
+        self.print_scp = PrintSCP()
+        # noinspection PyUnresolvedReferences
+        self.print_scp.film.connect(self.film_handler)
+        self.scp = StoreSCP(self.pipeline, self.print_scp if DICOM_PRINT_SCP else None)
+        print('Print server is listening on port {}'.format(DICOM_SCP_PORT))
+
+    @Slot(DecodedImage)
+    def decoded_handler(self, image: DecodedImage):
+        ds = image.header
+        if self.study is None or self.study.patient_id != ds.PatientID:
+            # new study starting, the previous one is complete
+            self.print_study()
+            self.study = PrintStudy(ds)
+
+        if spool.is_spooled(image.path):
+            self.spooled.append(image.path)
+        self.study.items.append(PrintItem(ImagePyramid.from_arrays(image.levels),
+                                          image.image_info, self.options))
+        self.pipeline.task_done()
+        self.idle_timer.start()
+
+    @Slot(Film)
+    def film_handler(self, film: Film):
+        self.print_queue.submit(PrintJob(film, server_printer(film.name)))
+
+    @Slot()
+    def idle_handler(self):
+        if self.pipeline.depth:
+            # images are still being decoded
+            self.idle_timer.start()
+            return
+        self.print_study()
+
+    def print_study(self):
+        if self.study is None:
+            return
+        # images are in memory, the next study comes in while this one prints
+        self.print_queue.submit(PrintJob(self.study, server_printer(self.study.name)))
+        spool.remove(self.spooled)
+        self.spooled = []
+        # the same patient coming again is a new print job
+        self.study = None
@@ -0,0 +1,58 @@
+import numpy
+from PIL import Image
+from PySide6.QtCore import Qt, QSize
+from PySide6.QtGui import QImage
+
+from settings import settings
+from tools import array_to_qimage
+
+# loading settings:
+# preview level, as the image list and OptionsForm show images
+VIEW_IMAGE_WIDTH = int(settings.VIEW_IMAGE_WIDTH)
+# thumbnail level, quarter of the preview
+THUMBNAIL_WIDTH = VIEW_IMAGE_WIDTH // 4
+
+
+def _scaled_array(array: numpy.ndarray, width: int) -> numpy.ndarray:
+    """
+    *array* smoothly scaled to *width* keeping the aspect ratio. PIL, not
+    QImage: Qt deadlocks in a forked process decode worker on Linux.
+    """
+    height = max(1, int(float(array.shape[0]) * float(width / float(array.shape[1]))))
+    return numpy.asarray(Image.fromarray(array).resize((width, height), Image.BILINEAR))
+
+
+def build_levels(array: numpy.ndarray) -> list:
+    """
+    Full, preview and thumbnail arrays of a decoded image, each scaled
+    from the previous one. Runs in the decode worker, GUI-free.
+    """
+    levels = [array]
+    for width in (VIEW_IMAGE_WIDTH, THUMBNAIL_WIDTH):
+        if 0 < width < levels[-1].shape[1]:
+            levels.append(_scaled_array(levels[-1], width))
+    return levels
+
+
+class ImagePyramid:
+    """ Image at several resolutions, largest first """
+
+    def __init__(self, levels: list):
+        self.levels = levels
+
+    @classmethod
+    def from_arrays(cls, arrays: list) -> 'ImagePyramid':
+        return cls([array_to_qimage(array) for array in arrays])
+
+    @property
+    def image(self) -> QImage:
+        """ Full resolution """
+        return self.levels[0]
+
+    def nearest(self, size: QSize) -> QImage:
+        """ Smallest level to be scaled into *size* without upscaling """
+        for image in reversed(self.levels):
+            fitted = image.size().scaled(size, Qt.KeepAspectRatio)
+            if image.width() >= fitted.width():
+                return image
+        return self.image
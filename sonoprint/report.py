@@ -1,10 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 from PySide6.QtCore import QPoint, Qt, QRect, QSize
-from PySide6.QtGui import QPainter, QFont, QPageSize
+from PySide6.QtGui import QPainter, QFont, QPageSize, QImage
 from PySide6.QtPrintSupport import QPrinter
 
-from dicomimagelist import DicomImageList
 from settings import settings
-from tools import tune_qpixmap
+from tune_cache import TuneCache
 
 # dimensions are in millimeters
 MIN_ITEM_WIDTH = int(settings.MIN_ITEM_WIDTH)
@@ -16,6 +18,12 @@ RIGHT_MARGIN = int(settings.RIGHT_MARGIN)
 BOX_MARGINS = int(settings.BOX_MARGINS)
 
 PRINTER_DPI = int(settings.PRINTER_DPI)
+# Images are scaled and tuned for printing on this number of threads
+PRINT_WORKERS = int(settings.PRINT_WORKERS)
+# Print images kept for print preview repaints, MB
+PRINT_CACHE_MB = int(settings.PRINT_CACHE_MB)
+# Pages sent to a printer as one image each: 0 - off, 8 - grayscale, 1 - dithered
+PRINTER_RASTER = int(settings.PRINTER_RASTER)
 
 TOP_CLINIC_FONT = QFont(settings.TOP_CLINIC_FONT_NAME,
                         int(settings.TOP_CLINIC_FONT_SIZE),
@@ -34,17 +42,39 @@ BOX_COMMENT_FONT = QFont(settings.BOX_COMMENT_FONT_NAME,
                          int(settings.BOX_COMMENT_FONT_SIZE))
 
 
+# print images only, they do not push the images on screen out of tune_cache
+cache = TuneCache(PRINT_CACHE_MB * 2 ** 20)
+
+
 def mm_to_pix(mm: int) -> int:
     return int(mm * PRINTER_DPI / 25.4)
 
 
-def make(printer: QPrinter, viewer: DicomImageList):
+def _raster_page(page_image: QImage, raster: int) -> QImage:
+    """ Painted page in the PRINTER_RASTER format """
+    if raster == 1:
+        # Floyd-Steinberg error diffusion, text and lines stay sharp
+        return page_image.convertToFormat(QImage.Format_Mono,
+                                          Qt.MonoOnly | Qt.DiffuseDither)
+    return page_image
+
+
+def make(printer: QPrinter, viewer, raster: int = None, spooling=None):
+    """
+    *viewer* is DicomImageList, print_server.PrintStudy, print_scp.Film or print_queue.PrintJob:
+    clinic, study_info, device_info and boxes() with isChecked(), print_images(),
+    options, image_id and comment_text().
+    *raster* is the PRINTER_RASTER mode, by default used for printers only.
+    *spooling* is called when all pages are painted and go to the printer.
+    """
     printer.setResolution(PRINTER_DPI)
     printer.setColorMode(QPrinter.ColorMode.GrayScale)
     printer.setPageSize(QPageSize(QPageSize.A4))
     printer.setFullPage(True)
 
     painter = QPainter()
+    if raster is None:
+        raster = PRINTER_RASTER if printer.outputFormat() == QPrinter.NativeFormat else 0
 
     # --------------------------- grid calculating ----------------------------
     paper_width = mm_to_pix(printer.widthMM())
@@ -67,6 +97,9 @@ def make(printer: QPrinter, viewer: DicomImageList):
         item_width = int(center_rect.width() / columns)
         item_height = int(center_rect.height() / rows)
 
+    box_size = QSize(item_width - mm_to_pix(BOX_MARGINS * 2),
+                     item_height - mm_to_pix(BOX_MARGINS * 2))
+
     # ------------------------- end (grid calculating) ------------------------
 
     def _draw_top():
@@ -100,34 +133,25 @@ def make(printer: QPrinter, viewer: DicomImageList):
         painter.drawText(target_rect, Qt.AlignRight | Qt.AlignTop,
                          viewer.device_info)
 
-    def _draw_image_box(box_, p: QPoint):
-        box_rect = QRect(p.x() + mm_to_pix(BOX_MARGINS),
-                         p.y() + mm_to_pix(BOX_MARGINS),
-                         item_width - mm_to_pix(BOX_MARGINS * 2),
-                         item_height - mm_to_pix(BOX_MARGINS * 2))
+    def _draw_image_box(box_, tuned_image: QImage, image_info: str, p: QPoint):
+        box_rect = QRect(QPoint(p.x() + mm_to_pix(BOX_MARGINS),
+                                p.y() + mm_to_pix(BOX_MARGINS)),
+                         box_size)
         # -------------------------- header printing --------------------------
         header_rect = QRect(box_rect.left(),
                             box_rect.top(),
                             box_rect.width(), 1)
         painter.setFont(BOX_HEADER_FONT)
         flags = Qt.AlignLeft | Qt.AlignBottom
-        br = painter.boundingRect(header_rect, flags, box_.image_info)
+        br = painter.boundingRect(header_rect, flags, image_info)
         header_rect.setHeight(br.height())
-        painter.drawText(header_rect, flags, box_.image_info)
+        painter.drawText(header_rect, flags, image_info)
         # -------------------------- image printing ---------------------------
-        scaled_image = box_.pixmap.scaled(box_rect.width(),
-                                          box_rect.height(),
-                                          Qt.KeepAspectRatio,
-                                          Qt.SmoothTransformation)
-        tuned_image = tune_qpixmap(scaled_image,
-                                   box_.options.brightness(),
-                                   box_.options.contrast(),
-                                   box_.options.sharpness())
         image_rect = QRect(box_rect.left(),
                            box_rect.top() + header_rect.height() + 1,
                            box_rect.width(),
-                           scaled_image.height())
-        painter.drawPixmap(image_rect, tuned_image)
+                           tuned_image.height())
+        painter.drawImage(image_rect, tuned_image)
         # -------------------------- comment printing -------------------------
         comment_rect = QRect(box_rect.left(),
                              image_rect.top() + image_rect.height() + 1,
@@ -135,25 +159,79 @@ def make(printer: QPrinter, viewer: DicomImageList):
                              box_rect.bottom() - image_rect.bottom())
         painter.setFont(BOX_COMMENT_FONT)
         flags = Qt.AlignLeft | Qt.AlignTop | Qt.TextWordWrap
-        br = painter.boundingRect(comment_rect, flags, box_.comment.text())
+        br = painter.boundingRect(comment_rect, flags, box_.comment_text())
         comment_rect.setHeight(br.height())
-        painter.drawText(comment_rect, flags, box_.comment.text())
-
-    def _page_engine() -> QPoint:
+        painter.drawText(comment_rect, flags, box_.comment_text())
+
+    def _cell_point(cell: int) -> QPoint:
+        row, column = divmod(cell, columns)
+        return QPoint(column * item_width + center_rect.x(),
+                      row * item_height + center_rect.y())
+
+    def _pages():
+        """ (box, pyramid, image_info) of every page, clip frames are decoded lazily """
+        prints = ((box, pyramid, image_info)
+                  for box in viewer.boxes() if box.isChecked()
+                  for pyramid, image_info in box.print_images())
         while True:
-            _draw_top()
-            _draw_bottom()
-            for row in range(rows):
-                for column in range(columns):
-                    x = column * item_width + center_rect.x()
-                    y = row * item_height + center_rect.y()
-                    yield QPoint(x, y)
-            printer.newPage()
-
-    painter.begin(printer)
-    point = _page_engine()
-    for box in viewer.boxes():
-        if box.isChecked():
-            # noinspection PyTypeChecker
-            _draw_image_box(box, next(point))
-    painter.end()
+            page = list(islice(prints, rows * columns))
+            if not page:
+                return
+            yield page
+
+    def _prepare(page) -> list:
+        # NumPy and QImage.scaled release the GIL, so threads run in parallel
+        return [(box, image_info,
+                 pool.submit(cache.tune, (box.image_id, image_info), pyramid.nearest(box_size),
+                             box.options.brightness(), box.options.contrast(),
+                             box.options.sharpness(), box_size))
+                for box, pyramid, image_info in page]
+
+    # Print images are kept in the print cache for print preview repaints,
+    # not more than PRINT_CACHE_MB. The rest are prepared one page ahead
+    # and freed once painted, so memory does not grow with the study.
+    with ThreadPoolExecutor(PRINT_WORKERS) as pool:
+        pages = _pages()
+        prepared = _prepare(next(pages, []))
+        if raster:
+            # the page is painted into one image, the printer gets nothing else
+            page_image = QImage(paper_width, paper_height, QImage.Format_Grayscale8)
+            page_image.setDotsPerMeterX(round(PRINTER_DPI / 0.0254))
+            page_image.setDotsPerMeterY(round(PRINTER_DPI / 0.0254))
+            printer_painter = QPainter(printer)
+        else:
+            painter.begin(printer)
+        try:
+            number = 0
+            while prepared:
+                page, prepared = prepared, _prepare(next(pages, []))
+                if raster:
+                    page_image.fill(Qt.white)
+                    painter.begin(page_image)
+                elif number:
+                    printer.newPage()
+                _draw_top()
+                _draw_bottom()
+                for cell, (box, image_info, future) in enumerate(page):
+                    tuned_image = future.result()
+                    _draw_image_box(box, tuned_image, image_info, _cell_point(cell))
+                del page, tuned_image
+                if raster:
+                    painter.end()
+                    if number:
+                        printer.newPage()
+                    printer_painter.drawImage(QRect(0, 0, paper_width, paper_height),
+                                              _raster_page(page_image, raster))
+                number += 1
+            if spooling is not None:
+                spooling()
+        except BaseException:
+            # images of the failed report are not scaled and tuned any more
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            # an active painter keeps the printer or the PDF file open
+            if painter.isActive():
+                painter.end()
+            if raster:
+                printer_painter.end()
@@ -0,0 +1,109 @@
+import sys
+
+from pydicom.uid import (ImplicitVRLittleEndian, ExplicitVRLittleEndian, JPEGBaseline8Bit,
+                         JPEGLosslessSV1, JPEGLSLossless, JPEGLSNearLossless, RLELossless)
+from pynetdicom import AE, evt
+from pynetdicom.events import Event
+
+import spool
+from decoder import DecodePipeline
+from settings import settings
+from tools import try_port, log_to_file, get_decodable_syntaxes
+
+# loading settings:
+# port for listening
+DICOM_SCP_PORT = int(settings.DICOM_SCP_PORT)
+# Simultaneous associations, e.g. scanners pushing at once
+DICOM_MAX_ASSOCIATIONS = int(settings.DICOM_MAX_ASSOCIATIONS)
+# Maximum PDU size we receive, 0 - unlimited
+DICOM_MAX_PDU_SIZE = int(settings.DICOM_MAX_PDU_SIZE)
+
+# UltrasoundImageStorage, UltrasoundMultiFrameImageStorage
+STORAGE_SOP_CLASSES = ('1.2.840.10008.5.1.4.1.1.6.1',
+                       '1.2.840.10008.5.1.4.1.1.3.1')
+# compressed ones are accepted only if a local codec can decode them
+TRANSFER_SYNTAXES = (JPEGBaseline8Bit, JPEGLSLossless, JPEGLSNearLossless,
+                     JPEGLosslessSV1, RLELossless,
+                     ExplicitVRLittleEndian, ImplicitVRLittleEndian)
+
+
+def ae_title_str(ae_title) -> str:
+    # pynetdicom < 2.0 gives bytes, newer ones give str
+    if isinstance(ae_title, bytes):
+        ae_title = ae_title.decode('UTF-8')
+    return ae_title.strip()
+
+
+class StoreSCP:
+    """
+    Storage SCP, received datasets are spooled and submitted to *pipeline*.
+    Shared by the main window and the headless print server.
+    *print_scp* (print_scp.PrintSCP) serves DICOM printing on the same AE.
+    """
+
+    def __init__(self, pipeline: DecodePipeline, print_scp=None):
+        self.pipeline = pipeline
+        # C-STORE requests refused with Out of Resources
+        self.rejected = 0
+
+        # --------------------------
+        # Init and Start SCP server
+        # UltrasoundImageStorage - 1.2.840.10008.5.1.4.1.1.6.1
+        # UltrasoundMultiFrameImageStorage - 1.2.840.10008.5.1.4.1.1.3.1
+        # --------------------------
+        self.__handlers = [(evt.EVT_C_STORE, self.handle_c_store),
+                           (evt.EVT_C_ECHO, self.handle_c_echo)]
+        self.ae = AE()
+        self.ae.maximum_associations = DICOM_MAX_ASSOCIATIONS
+        self.ae.maximum_pdu_size = DICOM_MAX_PDU_SIZE
+        transfer_syntaxes = get_decodable_syntaxes(TRANSFER_SYNTAXES)
+        for uid in set(TRANSFER_SYNTAXES) - set(transfer_syntaxes):
+            print('No codec for {}, not accepted'.format(uid.name))
+        for sop_class in STORAGE_SOP_CLASSES:
+            self.ae.add_supported_context(sop_class, transfer_syntaxes)
+        self.ae.add_supported_context('1.2.840.10008.1.1',
+                                      ImplicitVRLittleEndian)
+        if print_scp is not None:
+            # scanners printing films to us directly
+            self.__handlers += print_scp.handlers()
+            for sop_class in print_scp.SOP_CLASSES:
+                self.ae.add_supported_context(sop_class, [ExplicitVRLittleEndian,
+                                                          ImplicitVRLittleEndian])
+        if try_port(DICOM_SCP_PORT):
+            self.ae.start_server(('', DICOM_SCP_PORT), block=False, ae_title=b'SONOPRINT',
+                                 evt_handlers=self.__handlers)
+        else:
+            sys.exit(-1)
+        # --------------------------
+
+    def handle_c_store(self, event: Event) -> int:
+        """
+        Handle EVT_C_STORE events.
+        https://ru.wikipedia.org/wiki/DICOM
+        """
+        print('{}: {} from {} on {} (port {})'.
+              format(event.timestamp,
+                     event.event.description,
+                     ae_title_str(event.assoc.requestor.ae_title),
+                     event.assoc.requestor.address,
+                     event.assoc.requestor.port))
+        if self.pipeline.full():
+            # the scanner retries later
+            self.rejected += 1
+            print('Ingest queue is full, C-STORE refused')
+            return 0xA700
+        try:
+            self.pipeline.submit(spool.write(event))
+        except Exception as e:
+            log_to_file('\n HANDLE_C_STORE ERROR: {}'.format(e))
+            return 0xC001
+        return 0x0000
+
+    def handle_c_echo(self, event: Event) -> int:
+        print('{}: {} from {} on {} (port {})'.
+              format(event.timestamp,
+                     event.event.description,
+                     ae_title_str(event.assoc.requestor.ae_title),
+                     event.assoc.requestor.address,
+                     event.assoc.requestor.port))
+        return 0x0000
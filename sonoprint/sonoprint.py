@@ -1,18 +1,23 @@
+import os
 import subprocess
 import sys
+from multiprocessing import freeze_support
 
 from PySide6 import QtPrintSupport
-from PySide6.QtCore import QRect, Signal
-from PySide6.QtGui import QIcon, QAction
-from PySide6.QtPrintSupport import QPrinter
+from PySide6.QtCore import QRect, Signal, QTimer
+from PySide6.QtGui import QIcon, QAction, QGuiApplication
+from PySide6.QtPrintSupport import QPrinter, QPrintDialog
 from PySide6.QtWidgets import (QMainWindow, QApplication,
-                               QFileDialog)
-from pydicom import dcmread
+                               QFileDialog, QLabel)
 
 # noinspection PyUnresolvedReferences
 import rc_icons
 import report
+import tune_cache
 from dicomimagelist import DicomImageList
+from print_queue import PrintJob, PrintQueue
+from print_scp import Film
+from print_server import PrintServer, server_printer
 from settings import settings, unpack_int, config_path
 from tools import log_to_file
 
@@ -44,11 +49,17 @@ class Viewer(QMainWindow):
             open_action.triggered.connect(self.open_dcm_file)
 
             print_action = QAction(QIcon(':/icons/print.ico'),
-                                   'Preview Print', self)
+                                   'Print', self)
             print_action.setShortcut('Ctrl+P')
-            print_action.setStatusTip('Preview Print')
+            print_action.setStatusTip('Print in background')
             # noinspection PyUnresolvedReferences
-            print_action.triggered.connect(self.preview_print)
+            print_action.triggered.connect(self.print_study)
+
+            preview_action = QAction('Preview Print', self)
+            preview_action.setShortcut('Ctrl+Shift+P')
+            preview_action.setStatusTip('Preview Print')
+            # noinspection PyUnresolvedReferences
+            preview_action.triggered.connect(self.preview_print)
 
             settings_action = QAction(QIcon(':/icons/settings.ico'),
                                       'Settings', self)
@@ -62,13 +73,34 @@ class Viewer(QMainWindow):
             # noinspection PyUnresolvedReferences
             exit_action.triggered.connect(self.close)
 
-            self.statusBar()
+            self.ingest_label = QLabel(self.viewer.ingest_status())
+            self.statusBar().addPermanentWidget(self.ingest_label)
+            self.ingest_timer = QTimer(self)
+            # noinspection PyUnresolvedReferences
+            self.ingest_timer.timeout.connect(self.show_ingest_status)
+            self.ingest_timer.start(500)
+
+            self.print_queue = PrintQueue()
+            self.print_label = QLabel(self.print_queue.status())
+            self.statusBar().addPermanentWidget(self.print_label)
+            # noinspection PyUnresolvedReferences
+            self.print_queue.changed.connect(self.show_print_status)
+            # noinspection PyUnresolvedReferences
+            self.viewer.print_scp.film.connect(self.print_film)
+            # noinspection PyUnresolvedReferences
+            self.ingest_timer.timeout.connect(self.show_print_status)
+
+            self.cache_label = QLabel(tune_cache.cache.status())
+            self.statusBar().addPermanentWidget(self.cache_label)
+            # noinspection PyUnresolvedReferences
+            self.ingest_timer.timeout.connect(self.show_cache_status)
 
             menu_bar = self.menuBar()
             file_menu = menu_bar.addMenu('&File')
             file_menu.addAction(new_action)
             file_menu.addAction(open_action)
             file_menu.addAction(print_action)
+            file_menu.addAction(preview_action)
             file_menu.addAction(settings_action)
             file_menu.addAction(exit_action)
 
@@ -89,6 +121,15 @@ class Viewer(QMainWindow):
             log_to_file(str(e))
             sys.exit(-1)
 
+    def show_ingest_status(self):
+        self.ingest_label.setText(self.viewer.ingest_status())
+
+    def show_print_status(self):
+        self.print_label.setText(self.print_queue.status())
+
+    def show_cache_status(self):
+        self.cache_label.setText(tune_cache.cache.status())
+
     def new_study(self):
         self.viewer.clear()
 
@@ -100,11 +141,23 @@ class Viewer(QMainWindow):
             files = result[0]
             if files:
                 for fn in files:
-                    self.viewer.store_signal_handler(dcmread(fn))
+                    self.viewer.pipeline.submit(fn)
         except Exception as e:
             log_to_file('Open_File dialog failed: {}'.format(e))
             # print(e)  # TODO msg box
 
+    def print_study(self):
+        if any(box.isChecked() for box in self.viewer.boxes()):
+            printer = QPrinter()
+            dialog = QPrintDialog(printer, self)
+            if dialog.exec():
+                # images, comments and options as they are now
+                self.print_queue.submit(PrintJob(self.viewer, printer))
+
+    def print_film(self, film: Film):
+        # films printed by DICOM do not wait for the operator
+        self.print_queue.submit(PrintJob(film, server_printer(film.name)))
+
     def preview_print(self):
         if any(box.isChecked() for box in self.viewer.boxes()):
             dialog = QtPrintSupport.QPrintPreviewDialog()
@@ -128,6 +181,14 @@ class Sonoprint(QApplication):
 
 
 if __name__ == '__main__':
-    app = Sonoprint(sys.argv)
-    ex = Viewer()
+    # needed for DECODE_POOL = process in the pyinstaller build
+    freeze_support()
+    if '--headless' in sys.argv:
+        # print server without display and widgets
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        app = QGuiApplication(sys.argv)
+        ex = PrintServer()
+    else:
+        app = Sonoprint(sys.argv)
+        ex = Viewer()
     sys.exit(app.exec())
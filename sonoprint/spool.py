@@ -0,0 +1,90 @@
+import mmap
+import os
+import struct
+from uuid import uuid4
+
+from pydicom import Dataset, dcmread
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom.events import Event
+
+from settings import settings
+from tools import get_fragments, log_to_file
+
+# loading settings:
+# Received datasets are written here and decoded later
+SPOOL_DIR = os.path.abspath(settings.SPOOL_DIR)
+# 1 - write encoded dataset as received, 0 - decode and save it again
+SPOOL_RAW = int(settings.SPOOL_RAW)
+
+PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00'
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def write(event: Event) -> str:
+    """ Write C-STORE dataset to the spool and return its path """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    # SOP Instance UID comes from the network, it is no file name
+    path = os.path.join(SPOOL_DIR, '{}.dcm'.format(uuid4().hex))
+    part_path = path + '.part'
+    if SPOOL_RAW:
+        with open(part_path, 'wb') as f:
+            f.write(b'\x00' * 128)
+            f.write(b'DICM')
+            write_file_meta_info(f, event.file_meta)
+            f.write(event.request.DataSet.getbuffer())
+    else:
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+        ds.save_as(part_path, write_like_original=False)
+    # readers never see half written files
+    os.replace(part_path, path)
+    return path
+
+
+def read(path: str) -> Dataset:
+    """
+    Read DICOM file without loading PixelData into memory:
+    PixelData is a read-only view of the memory-mapped file
+    """
+    with open(path, 'rb') as f:
+        ds = dcmread(f, stop_before_pixels=True)
+        position = f.tell()
+        if os.fstat(f.fileno()).st_size == 0:
+            return ds
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    if data[position:position + 4] != PIXEL_DATA_TAG:
+        return ds
+    if ds.is_implicit_VR:
+        vr = 'OW'
+        length, = struct.unpack_from('<I', data, position + 4)
+        start = position + 8
+    else:
+        vr = bytes(data[position + 4:position + 6]).decode()
+        length, = struct.unpack_from('<I', data, position + 8)
+        start = position + 12
+    if length == UNDEFINED_LENGTH:
+        # encapsulated: items up to the sequence delimiter
+        fragments = get_fragments(data[start:])
+        length = fragments[-1][1] if fragments else 0
+    ds.add_new(0x7FE00010, vr, data[start:start + length])
+    return ds
+
+
+def is_spooled(path: str) -> bool:
+    return os.path.dirname(os.path.realpath(path)) == os.path.realpath(SPOOL_DIR)
+
+
+def remove(paths):
+    """ Remove spooled files, files still in use are left for purge() """
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            log_to_file('SPOOL: cannot remove {}: {}'.format(path, e))
+
+
+def purge():
+    """ Remove everything left in the spool by previous runs """
+    if os.path.isdir(SPOOL_DIR):
+        remove(os.path.join(SPOOL_DIR, name) for name in os.listdir(SPOOL_DIR))
@@ -1,15 +1,22 @@
 import os
 import socket
+import struct
+from functools import lru_cache
 
 import numpy
-from PIL import Image, ImageQt, ImageEnhance
-from PySide6.QtGui import QImage, QPixmap
+from PIL import Image
+from PySide6.QtGui import QImage
+import pydicom.config
 from pydicom import Dataset
 from pydicom import dcmread
 from pydicom.charset import python_encoding
+from pydicom.pixel_data_handlers import pylibjpeg_handler
+from pydicom.pixel_data_handlers.util import convert_color_space
 
 from datetime import datetime
 
+ITEM_TAG = b'\xfe\xff\x00\xe0'
+
 
 def _get_lut_value(data, window, level):
     """
@@ -24,6 +31,31 @@ def _get_lut_value(data, window, level):
                                                   (window - 1) + 0.5) * (255 - 0)])
 
 
+@lru_cache(maxsize=64)
+def _get_lut(dtype: str, window, level) -> numpy.ndarray:
+    """
+    uint8 Look-Up Table with _get_lut_value() of every value of *dtype*,
+    indexed by the unsigned view of the value.
+    """
+    unsigned = dtype.replace('i', 'u')
+    size = 2 ** (8 * numpy.dtype(dtype).itemsize)
+    domain = numpy.arange(size, dtype=unsigned).view(dtype)
+    lut = _get_lut_value(domain, window, level).astype(numpy.uint8)
+    lut.setflags(write=False)
+    return lut
+
+
+def apply_window(data: numpy.ndarray, window, level) -> numpy.ndarray:
+    """
+    Same as _get_lut_value(), but straight to uint8 with one table
+    gather per image. Table is built once for every dtype/window/level.
+    """
+    if data.dtype.str[1:] not in ('u1', 'u2', 'i2'):
+        return _get_lut_value(data, window, level)
+    lut = _get_lut(data.dtype.str, window, level)
+    return lut[data.view(data.dtype.str.replace('i', 'u'))]
+
+
 def _get_pil_image(dataset: Dataset) -> Image:
     """
     Get Image object from Python Imaging Library(PIL)
@@ -64,7 +96,7 @@ def _get_pil_image(dataset: Dataset) -> Image:
         ww = int(ew.value[0] if ew.VM > 1 else ew.value)
         # noinspection PyUnresolvedReferences
         wc = int(ec.value[0] if ec.VM > 1 else ec.value)
-        image = _get_lut_value(dataset.pixel_array, ww, wc)
+        image = apply_window(dataset.pixel_array, ww, wc)
         # Convert mode to L since LUT has only 256 values:
         #   http://www.pythonware.com/library/pil/handbook/image.htm
         # im = PIL.Image.fromarray(image).convert('L') # Grey (from manual)
@@ -73,27 +105,208 @@ def _get_pil_image(dataset: Dataset) -> Image:
     return image
 
 
-def get_pixmap_from(dataset: Dataset) -> QPixmap:
-    """ Return QT5 QPixmap from DICOM dataset"""
-    image = _get_pil_image(dataset)
-    # image = _process(image)
-    data = image.tobytes("raw", "RGB")
-    qim = QImage(data, image.size[0], image.size[1], QImage.Format_RGB888)
-    return QPixmap(qim)
+def _get_pixel_view(dataset: Dataset, frame=0) -> numpy.ndarray:
+    """
+    Pixel data (rows, columns[, samples]) of *frame* as a read-only view
+    of PixelData for native (uncompressed) datasets: only bytes of the
+    frame are read. Compressed and 1 bit ones are decoded by pydicom, the
+    decoded clip is not kept on *dataset*.
+    """
+    meta = getattr(dataset, 'file_meta', None)
+    syntax = meta.get('TransferSyntaxUID') if meta is not None else None
+    bits = dataset.BitsAllocated
+    samples = dataset.SamplesPerPixel
+    planar = samples > 1 and dataset.get('PlanarConfiguration', 0) != 0
+    if syntax is None or syntax.is_compressed or bits == 1:
+        # bit-packed frames are not byte aligned, left to pydicom too
+        data = dataset.pixel_array
+        if int(dataset.get('NumberOfFrames', 1)) > 1:
+            data = data[frame].copy()
+        # pydicom caches the whole decoded pixel data on the dataset
+        del dataset._pixel_array
+        del dataset._pixel_id
+        return data
 
+    shape = (dataset.Rows, dataset.Columns)
+    count = dataset.Rows * dataset.Columns * samples
+    dtype = numpy.dtype('{}{}{}'.format('<' if syntax.is_little_endian else '>',
+                                        'i' if dataset.PixelRepresentation and bits > 8 else 'u',
+                                        bits // 8))
+    data = numpy.frombuffer(dataset.PixelData, dtype, count=count,
+                            offset=frame * count * dtype.itemsize)
+    if samples == 1:
+        return data.reshape(shape)
+    if planar:
+        # R plane, G plane, B plane
+        return data.reshape((samples,) + shape).transpose(1, 2, 0)
+    return data.reshape(shape + (samples,))
 
-def tune(pil_img: ImageQt, brightness, contrast, sharpness) -> QPixmap:
-    sh = float(sharpness) / 100
-    br = float(brightness) / 100
-    co = float(contrast) / 100
-    tmp_img = ImageEnhance.Sharpness(pil_img).enhance(sh)
-    tmp_img = ImageEnhance.Brightness(tmp_img).enhance(br)
-    tmp_img = ImageEnhance.Contrast(tmp_img).enhance(co)
-    return ImageQt.toqpixmap(tmp_img)
 
+def get_image_array(dataset: Dataset, rect=None, frame=0) -> numpy.ndarray:
+    """
+    Return uint8 C-contiguous array of *frame* from DICOM dataset, cropped
+    to *rect* = (x, y, width, height) before any conversion.
+    MONOCHROME (one sample per pixel) data stays a single channel
+    (rows, columns), color data is (rows, columns, 3) RGB.
+    Same pixels as _get_pil_image().
+    """
+    if 'PixelData' not in dataset:
+        raise TypeError("Cannot show image -- DICOM dataset does not have "
+                        "pixel data")
+    data = _get_pixel_view(dataset, frame)
+    if rect is not None:
+        x, y, width, height = rect
+        data = data[y:y + height, x:x + width]
+    if dataset.get('PhotometricInterpretation', '').startswith('YBR'):
+        # JPEG Baseline color comes as YCbCr, as decoded (422 is upsampled)
+        data = convert_color_space(data, 'YBR_FULL', 'RGB')
+
+    if ('WindowWidth' not in dataset) or ('WindowCenter' not in dataset):
+        bits = dataset.BitsAllocated
+        samples = dataset.SamplesPerPixel
+        if bits == 8 and samples in (1, 3):
+            image = numpy.array(data, dtype=numpy.uint8)
+        elif bits == 16:
+            # PIL clips 'I;16' to 255 on conversion
+            image = numpy.minimum(data, 255).astype(numpy.uint8)
+        else:
+            raise TypeError("Don't know PIL mode for %d BitsAllocated "
+                            "and %d SamplesPerPixel" % (bits, samples))
+    else:
+        ew = dataset['WindowWidth']
+        ec = dataset['WindowCenter']
+        # noinspection PyUnresolvedReferences
+        ww = int(ew.value[0] if ew.VM > 1 else ew.value)
+        # noinspection PyUnresolvedReferences
+        wc = int(ec.value[0] if ec.VM > 1 else ec.value)
+        image = apply_window(data, ww, wc)
 
-def tune_qpixmap(pixmap: QPixmap, brightness, contrast, sharpness) -> QPixmap:
-    return tune(ImageQt.fromqpixmap(pixmap), brightness, contrast, sharpness)
+    return numpy.ascontiguousarray(image)
+
+
+def array_to_qimage(array: numpy.ndarray) -> QImage:
+    """
+    Wrap C-contiguous uint8 array (rows, columns) or (rows, columns, 3)
+    as Format_Grayscale8 or Format_RGB888 QImage without copying.
+    The array is kept alive as long as the QImage.
+    """
+    array = numpy.ascontiguousarray(array)
+    image_format = QImage.Format_Grayscale8 if array.ndim == 2 else QImage.Format_RGB888
+    image = QImage(array.data, array.shape[1], array.shape[0],
+                   array.strides[0], image_format)
+    image.ndarray = array
+    return image
+
+
+def qimage_to_array(image: QImage, writable: bool = False) -> numpy.ndarray:
+    """
+    View Format_Grayscale8 or Format_RGB888 QImage as uint8 array
+    without copying. The view is valid while *image* lives.
+    """
+    if image.format() == QImage.Format_Grayscale8:
+        channels = 1
+    elif image.format() == QImage.Format_RGB888:
+        channels = 3
+    else:
+        raise TypeError('Unsupported QImage format {}'.format(image.format()))
+    array = numpy.frombuffer(image.bits() if writable else image.constBits(),
+                             numpy.uint8, count=image.sizeInBytes())
+    array = array.reshape(image.height(), image.bytesPerLine())
+    array = array[:, :image.width() * channels]
+    if channels == 3:
+        array = array.reshape(image.height(), image.width(), 3)
+    return array
+
+
+def get_fragments(pixel_data: bytes) -> list:
+    """ (start, stop) of every item value of encapsulated PixelData """
+    items = []
+    position = 0
+    while position + 8 <= len(pixel_data):
+        tag, length = struct.unpack_from('<4sI', pixel_data, position)
+        if tag != ITEM_TAG:
+            break
+        items.append((position + 8, position + 8 + length))
+        position += 8 + length
+    return items
+
+
+def _can_decode(handler, uid) -> bool:
+    if not (handler.is_available() and handler.supports_transfer_syntax(uid)):
+        return False
+    if handler is pylibjpeg_handler:
+        # pylibjpeg decodes only what its libjpeg, openjpeg or rle plugins do
+        from pylibjpeg.utils import get_pixel_data_decoders
+        return uid in get_pixel_data_decoders()
+    return True
+
+
+def get_decodable_syntaxes(syntaxes) -> list:
+    """ Transfer syntaxes of *syntaxes* some available pixel data handler can decode """
+    return [uid for uid in syntaxes
+            if any(_can_decode(handler, uid) for handler in pydicom.config.pixel_data_handlers)]
+
+
+def _blend(degenerate, image, factor: numpy.float32) -> numpy.ndarray:
+    """ PIL Image.blend() arithmetic: float32, clipped and truncated """
+    out = degenerate + factor * (image - degenerate)
+    return numpy.clip(out, 0, 255).astype(numpy.uint8)
+
+
+def _sharpen(image: numpy.ndarray, factor: numpy.float32) -> numpy.ndarray:
+    """
+    ImageEnhance.Sharpness: blend with ImageFilter.SMOOTH, i.e.
+    (3x3 box + 4 * centre) / 13, box summed separably. Edges are kept.
+    """
+    data = image.astype(numpy.float32)
+    rows = data[:, :-2] + data[:, 1:-1] + data[:, 2:]
+    box = rows[:-2] + rows[1:-1] + rows[2:]
+    centre = data[1:-1, 1:-1]
+    smooth = numpy.clip((box + 4 * centre) / 13 + 0.5, 0, 255).astype(numpy.uint8)
+    out = image.copy()
+    out[1:-1, 1:-1] = _blend(smooth.astype(numpy.float32), centre, factor)
+    return out
+
+
+def _get_mean_level(image: numpy.ndarray, lut: numpy.ndarray) -> int:
+    """ PIL ImageStat mean of lut[image] converted to 'L' """
+    if image.ndim == 2:
+        histogram = numpy.bincount(image.ravel(), minlength=256)
+        return int(numpy.dot(histogram, lut) / image.size + 0.5)
+    rgb = lut[image].astype(numpy.uint32)
+    # PIL 'RGB' to 'L' conversion
+    grey = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 +
+            rgb[..., 2] * 7471 + 0x8000) >> 16
+    return int(grey.mean() + 0.5)
+
+
+def tune_array(image: numpy.ndarray, brightness, contrast, sharpness) -> numpy.ndarray:
+    """
+    Sharpness, brightness and contrast of ImageEnhance in one go on
+    uint8 (rows, columns[, 3]) array, same as PIL within one level.
+    Brightness and contrast are one Look-Up Table gather.
+    """
+    sh = numpy.float32(float(sharpness) / 100)
+    br = numpy.float32(float(brightness) / 100)
+    co = numpy.float32(float(contrast) / 100)
+    if sh != 1:
+        image = _sharpen(image, sh)
+    levels = numpy.arange(256, dtype=numpy.float32)
+    brightness_lut = _blend(numpy.float32(0), levels, br)
+    mean = numpy.float32(_get_mean_level(image, brightness_lut))
+    contrast_lut = _blend(mean, levels, co)
+    return contrast_lut[brightness_lut][image]
+
+
+def tune_qimage(image: QImage, brightness, contrast, sharpness) -> QImage:
+    """
+    Tune Grayscale8/RGB888 QImage keeping its channels. The result owns
+    its pixels, so copies kept by QPainter engines outlive no buffer.
+    """
+    tuned_image = QImage(image.size(), image.format())
+    qimage_to_array(tuned_image, writable=True)[...] = \
+        tune_array(qimage_to_array(image), brightness, contrast, sharpness)
+    return tuned_image
 
 
 def try_port(port: int) -> bool:
@@ -123,6 +336,25 @@ def decode_rus(s: str, dataset: Dataset) -> str:
     return result
 
 
+def get_study_info(ds: Dataset) -> tuple:
+    """ (clinic, patient_id, study_info, device_info) of the report header """
+    clinic = '{}  '.format(decode_rus(ds.InstitutionName, ds))
+
+    patient_id = ds.PatientID
+    sd = ds.StudyDate
+    st = ds.StudyTime
+    dd = datetime.strptime('{} {}'.format(sd, st), '%Y%m%d %H%M%S')
+    study_info = 'Patient ID: {}, Study time: {}'. \
+        format(patient_id, dd.strftime('%d.%m.%Y %H:%M'))
+
+    device_info = 'Device: {} {} SN:{} firmware version: {}'. \
+        format(ds.Manufacturer,
+               ds.ManufacturerModelName,
+               ds.DeviceSerialNumber,
+               ds.SoftwareVersions)
+    return clinic, patient_id, study_info, device_info
+
+
 def log_to_file(message: str):
     log_path = './errors.log'
     with open(log_path, "a" if os.path.isfile(log_path) else "w") as log_file:
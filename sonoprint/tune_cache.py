@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from itertools import count
+from threading import Lock
+
+from PySide6.QtCore import Qt, QSize
+from PySide6.QtGui import QImage
+
+from settings import settings
+from tools import tune_qimage
+
+# loading settings:
+# Tuned images kept for ImageBox and OptionsForm, MB
+TUNE_CACHE_MB = int(settings.TUNE_CACHE_MB)
+
+_image_ids = count()
+
+
+def new_image_id() -> int:
+    """ Cache key part of a received image, unique for the process """
+    return next(_image_ids)
+
+
+def _image_id(key: tuple):
+    """ Received image of a key, its image id may come with a frame or image info """
+    return key[0][0] if isinstance(key[0], tuple) else key[0]
+
+
+class TuneCache:
+    """
+    LRU of tuned images keyed by (image id, resolution level, brightness,
+    contrast, sharpness), not more than *budget* bytes. Thread-safe,
+    images are tuned outside the lock.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.lock = Lock()
+        self.images = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def tune(self, image_id, image: QImage, brightness, contrast, sharpness,
+             size: QSize = None) -> QImage:
+        """
+        *image* scaled into *size* keeping the aspect ratio, if *size* is given,
+        and tuned. *image_id* must change whenever *image* does.
+        """
+        level = size or image.size()
+        key = (image_id, level.width(), level.height(), brightness, contrast, sharpness)
+        with self.lock:
+            tuned_image = self.images.get(key)
+            if tuned_image is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+                return tuned_image
+            self.misses += 1
+
+        if size is not None:
+            image = image.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        tuned_image = tune_qimage(image, brightness, contrast, sharpness)
+
+        with self.lock:
+            if key not in self.images and tuned_image.sizeInBytes() <= self.budget:
+                self.images[key] = tuned_image
+                self.size += tuned_image.sizeInBytes()
+                while self.size > self.budget:
+                    _, evicted = self.images.popitem(last=False)
+                    self.size -= evicted.sizeInBytes()
+                    self.evictions += 1
+        return tuned_image
+
+    def held(self, image_id: int) -> int:
+        """ Bytes of the tuned images of a received image, see imagestore """
+        with self.lock:
+            return sum(tuned_image.sizeInBytes() for key, tuned_image in self.images.items()
+                       if _image_id(key) == image_id)
+
+    def discard(self, image_id: int):
+        """ Drop the tuned images of a received image, its options or pixels are gone """
+        with self.lock:
+            for key in [key for key in self.images if _image_id(key) == image_id]:
+                self.size -= self.images.pop(key).sizeInBytes()
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.size = 0
+
+    def status(self) -> str:
+        return 'Tune cache: {:.1f}/{} MB, {} images, hits: {}, misses: {}, evictions: {}'. \
+            format(self.size / 2 ** 20, self.budget // 2 ** 20, len(self.images),
+                   self.hits, self.misses, self.evictions)
+
+
+# shared by the whole process
+cache = TuneCache(TUNE_CACHE_MB * 2 ** 20)